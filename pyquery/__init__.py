@@ -3,3 +3,4 @@
 # Distributed under the BSD license, see LICENSE.txt
 
 from .pyquery import PyQuery  # NOQA
+from .extractor import Extractor  # NOQA
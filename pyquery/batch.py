@@ -0,0 +1,115 @@
+# Copyright (C) 2008 - Olivier Lauzanne <olauzanne@gmail.com>
+#
+# Distributed under the BSD license, see LICENSE.txt
+"""Parse documents and extract data from them using a pool of processes.
+
+lxml trees can not be pickled so extractors must return plain python
+data.
+"""
+import itertools
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from .pyquery import PyQuery
+
+
+class Markup(str):
+    """A string of markup. Other strings given to :func:`load` and
+    :func:`extract` are paths::
+
+        >>> load(Markup('<p>a</p>')).text()
+        'a'
+    """
+
+    __slots__ = ()
+
+
+def load(source, parser=None):
+    """Return a PyQuery object for a path (a string or an ``os.PathLike``
+    object like :class:`pathlib.Path`, as in
+    :meth:`~pyquery.pyquery.PyQuery.iterparse`) or some markup (bytes or a
+    :class:`Markup` string)"""
+    if isinstance(source, (bytes, Markup)):
+        return PyQuery(source, parser=parser)
+    return PyQuery(filename=source, parser=parser)
+
+
+def apply(extractor, document):
+    """Apply extractor to a PyQuery object. extractor is a callable or a
+    mapping of names to selectors. In the later case the texts of the
+    matching elements are returned for each name::
+
+        >>> d = PyQuery('<ul><li>a</li><li>b</li></ul>')
+        >>> apply({'items': 'li'}, d)
+        {'items': ['a', 'b']}
+
+    """
+    if isinstance(extractor, dict):
+        return {name: [document._copy(e).text() for e in document(selector)]
+                for name, selector in extractor.items()}
+    return extractor(document)
+
+
+def _extract_chunk(chunk, extractor, parser):
+    return [apply(extractor, load(source, parser)) for source in chunk]
+
+
+def _chunks(sources, chunksize):
+    sources = iter(sources)
+    while True:
+        chunk = []
+        for source in itertools.islice(sources, chunksize):
+            if hasattr(source, 'read') and callable(source.read):
+                # file objects can't be sent to other processes. Their
+                # content is markup
+                source = source.read()
+                if isinstance(source, str):
+                    source = Markup(source)
+            chunk.append(source)
+        if not chunk:
+            return
+        yield chunk
+
+
+def extract(sources, extractor, processes=None, chunksize=8, ordered=True,
+            parser=None, executor=None, max_pending=None):
+    """Yield the result of extractor for each source. sources is an
+    iterable of paths, markup or file objects (see :func:`load`). Strings
+    are paths: wrap markup in :class:`Markup` or pass bytes. extractor is a
+    picklable callable taking a PyQuery object or a mapping of names to
+    selectors (see :func:`apply`).
+
+    Sources are sent to the worker processes by chunks of chunksize. At
+    most max_pending chunks (twice the number of processes by default) are
+    in progress so that sources are consumed as results are consumed.
+    Results are yielded in the order of sources, or as they are available
+    if ordered is false.
+    """
+    processes = processes or os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2 * processes
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=processes)
+    chunks = _chunks(sources, chunksize)
+    pending = deque()
+    try:
+        while True:
+            for chunk in itertools.islice(chunks, max_pending - len(pending)):
+                pending.append(executor.submit(
+                    _extract_chunk, chunk, extractor, parser))
+            if not pending:
+                break
+            if ordered:
+                yield from pending.popleft().result()
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield from future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown()
@@ -0,0 +1,75 @@
+# Copyright (C) 2008 - Olivier Lauzanne <olauzanne@gmail.com>
+#
+# Distributed under the BSD license, see LICENSE.txt
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LRUCache:
+    """A bounded mapping which discards the least recently used entries
+    first::
+
+        >>> cache = LRUCache(maxsize=2)
+        >>> cache['a'] = 1
+        >>> cache['b'] = 2
+        >>> cache.get('a')
+        1
+        >>> cache['c'] = 3
+        >>> cache.get('b') is None
+        True
+        >>> cache.info()
+        CacheInfo(hits=1, misses=1, maxsize=2, currsize=2)
+
+    A ``maxsize`` of ``0`` disables caching.
+    """
+
+    def __init__(self, maxsize=128):
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def resize(self, maxsize):
+        """Change the size of the cache, evicting entries if needed"""
+        with self._lock:
+            self.maxsize = maxsize
+            while self._data and len(self._data) > max(maxsize, 0):
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries and reset statistics"""
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        """Return hits, misses, maxsize and currsize as a named tuple"""
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
@@ -0,0 +1,236 @@
+# Copyright (C) 2008 - Olivier Lauzanne <olauzanne@gmail.com>
+#
+# Distributed under the BSD license, see LICENSE.txt
+"""Extract records from documents with a schema compiled once."""
+import re
+from collections import namedtuple
+
+from cssselect import parse as parse_selector
+
+from .pyquery import PyQuery
+
+# selector::text, selector::html or selector::attr(name)
+VALUE_RE = re.compile(r'^(?P<selector>.*?)\s*'
+                      r'(?:::(?P<kind>text|html|attr)'
+                      r'(?:\(\s*(?P<name>[^)\s]+)\s*\))?)?\s*$', re.DOTALL)
+
+EACH = '@each'
+
+Field = namedtuple('Field', ['selector', 'kind', 'name', 'many', 'converter'])
+
+Group = namedtuple('Group', ['selector', 'fields'])
+
+
+def compile_field(spec, converter=None):
+    """Return a :class:`Field` for a value specification like ``'h1'``,
+    ``'h1::text'``, ``'a::attr(href)'`` or ``['li::text']``"""
+    many = isinstance(spec, list)
+    if many:
+        if len(spec) != 1:
+            raise ValueError(f'List specifications must contain one '
+                             f'selector: {spec!r}')
+        spec, = spec
+    if not isinstance(spec, str):
+        raise TypeError(f'Invalid specification: {spec!r}')
+    match = VALUE_RE.match(spec)
+    kind = match.group('kind') or 'text'
+    name = match.group('name')
+    if (kind == 'attr') != (name is not None):
+        raise ValueError(f'Invalid value specification: {spec!r}')
+    selector = match.group('selector') or None
+    if selector is not None:
+        # raise SelectorError now rather than for each document
+        parse_selector(selector)
+    return Field(selector, kind, name, many, converter)
+
+
+def compile_schema(schema):
+    """Compile a schema to a tree of :class:`Group` and :class:`Field`"""
+    if isinstance(schema, dict):
+        selector = schema.get(EACH)
+        if selector is not None:
+            parse_selector(selector)
+        fields = {name: compile_schema(spec)
+                  for name, spec in schema.items() if name != EACH}
+        return Group(selector, fields)
+    if isinstance(schema, tuple):
+        spec, converter = schema
+        if not callable(converter):
+            raise TypeError(f'Converter must be callable: {converter!r}')
+        return compile_field(spec, converter)
+    return compile_field(schema)
+
+
+def convert(values, converter, many):
+    """Apply converter to a column. Missing values are kept as None"""
+    if many:
+        flat = [v for group in values for v in group]
+    else:
+        flat = [v for v in values if v is not None]
+    converted = iter(list(map(converter, flat)))
+    if many:
+        return [[next(converted) for v in group] for group in values]
+    return [v if v is None else next(converted) for v in values]
+
+
+def records(columns, start, end):
+    """Return the records of the rows start to end of columns"""
+    return [{name: values[i] for name, values in columns.items()}
+            for i in range(start, end)]
+
+
+class Extractor:
+    """Extract records from documents using a schema. The schema is a
+    mapping of names to:
+
+    - a selector, optionally followed by ``::text`` (the default),
+      ``::html`` or ``::attr(name)``. The value of the first matching
+      element is extracted, or None. A selector made only of ``::attr(name)``
+      refers to the element in scope
+
+    - a list containing such a selector to extract the values of all the
+      matching elements
+
+    - a ``(specification, converter)`` tuple. The converter is applied to
+      the values of the column, skipping missing values
+
+    - a nested schema. If it has an ``'@each'`` selector, a record is
+      extracted for each matching element, with selectors relative to it
+
+    Selectors are parsed and validated once::
+
+        >>> from pyquery import Extractor, PyQuery
+        >>> extractor = Extractor({
+        ...     'title': 'h1',
+        ...     'links': ['a::attr(href)'],
+        ...     'rows': {'@each': 'tr', 'name': 'td.name',
+        ...              'price': ('td.price', float)},
+        ... })
+        >>> d = PyQuery('''<div><h1>Shop</h1><a href="/a">a</a>
+        ...   <table><tr><td class="name">pen</td><td class="price">1.5</td>
+        ...   </tr><tr><td class="name">ink</td><td class="price">3</td></tr>
+        ...   </table></div>''')
+        >>> record = extractor(d)
+        >>> record['title'], record['links']
+        ('Shop', ['/a'])
+        >>> record['rows']
+        [{'name': 'pen', 'price': 1.5}, {'name': 'ink', 'price': 3.0}]
+
+    With ``columnar=True`` lists of records are returned as a mapping of
+    names to lists of values::
+
+        >>> extractor.extract(d, columnar=True)['rows']
+        {'name': ['pen', 'ink'], 'price': [1.5, 3.0]}
+
+    Extractors are picklable if their converters are, so they can be used
+    with :func:`pyquery.batch.extract`.
+    """
+
+    def __init__(self, schema):
+        if not isinstance(schema, dict):
+            raise TypeError('The schema must be a dict')
+        self.schema = schema
+        self.tree = compile_schema(schema)
+
+    def __call__(self, document):
+        return self.extract(document)
+
+    def __getstate__(self):
+        return self.schema
+
+    def __setstate__(self, schema):
+        self.__init__(schema)
+
+    def extract(self, document, columnar=False):
+        """Return the record of document, or its list of records if the
+        schema has an ``'@each'`` selector"""
+        if not isinstance(document, PyQuery):
+            document = PyQuery(document)
+        scope = [e for e in document if isinstance(e.tag, str)]
+        value, = self._group(self.tree, document, [scope],
+                             'descendant-or-self::', columnar)
+        return value
+
+    def extract_many(self, documents, columnar=False):
+        """Return the records of documents as a list or as a mapping of
+        names to lists of values if columnar is true::
+
+            >>> from pyquery import Extractor
+            >>> extractor = Extractor({'id': 'p::attr(id)', 'text': 'p'})
+            >>> extractor.extract_many(['<p id="a">1</p>', '<p id="b">2</p>'],
+            ...                        columnar=True)
+            {'id': ['a', 'b'], 'text': ['1', '2']}
+
+        The records of schemas with an ``'@each'`` selector are concatenated
+        in columnar mode.
+        """
+        results = [self.extract(document) for document in documents]
+        if not columnar:
+            return results
+        if self.tree.selector is not None:
+            # concatenate the records of all the documents
+            results = [record for rows in results for record in rows]
+        return {name: [record[name] for record in results]
+                for name in self.tree.fields}
+
+    def _select(self, document, selector, scopes, axis):
+        """Return the list of elements matching selector for each scope"""
+        if selector is None:
+            return scopes
+        if axis == 'descendant::':
+            return [document(scope).find(selector) if scope else []
+                    for scope in scopes]
+        return [document(selector, scope) if scope else []
+                for scope in scopes]
+
+    def _field(self, field, document, scopes, axis):
+        """Return the values of field for each scope"""
+        getter = self._getter(field, document)
+        values = []
+        for matches in self._select(document, field.selector, scopes, axis):
+            if field.many:
+                values.append([getter(e) for e in matches])
+            else:
+                values.append(getter(matches[0]) if matches else None)
+        if field.converter is not None:
+            values = convert(values, field.converter, field.many)
+        return values
+
+    def _getter(self, field, document):
+        if field.kind == 'attr':
+            name = field.name
+            return lambda e: e.get(name)
+        if field.kind == 'html':
+            return lambda e: document(e).html()
+        return lambda e: document(e).text()
+
+    def _group(self, group, document, scopes, axis, columnar):
+        """Return the record (or list of records) of group for each
+        scope"""
+        if group.selector is None:
+            rows = scopes
+        else:
+            # evaluate the fields once for the rows of all the scopes
+            matches = self._select(document, group.selector, scopes, axis)
+            rows = [[e] for elements in matches for e in elements]
+            axis = 'descendant::'
+        columns = {}
+        for name, node in group.fields.items():
+            if isinstance(node, Group):
+                columns[name] = self._group(node, document, rows, axis,
+                                            columnar)
+            else:
+                columns[name] = self._field(node, document, rows, axis)
+        if group.selector is None:
+            return records(columns, 0, len(scopes))
+        results = []
+        start = 0
+        for elements in matches:
+            end = start + len(elements)
+            if columnar:
+                results.append({name: values[start:end]
+                                for name, values in columns.items()})
+            else:
+                results.append(records(columns, start, end))
+            start = end
+        return results
@@ -0,0 +1,731 @@
+# Copyright (C) 2008 - Olivier Lauzanne <olauzanne@gmail.com>
+#
+# Distributed under the BSD license, see LICENSE.txt
+import re
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from weakref import WeakValueDictionary
+
+from cssselect import SelectorError, parse
+from cssselect.parser import (
+    Attrib,
+    Class,
+    CombinedSelector,
+    Element,
+    Function,
+    Hash,
+    Pseudo,
+    parse_series,
+)
+from lxml import etree
+
+from .cache import LRUCache
+
+# whitespace as understood by xpath's normalize-space()
+CLASS_SEPARATOR_RE = re.compile('[\x20\x09\x0D\x0A]+')
+
+# parsed selectors, keyed by (selector, lower_case)
+plan_cache = LRUCache(maxsize=1024)
+
+# parsed selectors with combinators, keyed by (selector, lower_case)
+chain_cache = LRUCache(maxsize=1024)
+
+# XPath's whitespace plus form feed, as in cssselect's ~= operator
+WHITESPACE_RE = re.compile('[ \t\r\n\f]')
+
+ATTRIBUTE_OPERATORS = {'exists', '=', '!=', '~=', '|=', '^=', '$=', '*='}
+
+Branch = namedtuple(
+    'Branch', ['tag', 'id', 'classes', 'attributes', 'texts', 'positions'])
+
+# (a, b, from_end, of_type) of structural pseudo classes
+STRUCTURAL_PSEUDOS = {
+    'first-child': [(0, 1, False, False)],
+    'last-child': [(0, 1, True, False)],
+    'only-child': [(0, 1, False, False), (0, 1, True, False)],
+    'first-of-type': [(0, 1, False, True)],
+    'last-of-type': [(0, 1, True, True)],
+    'only-of-type': [(0, 1, False, True), (0, 1, True, True)],
+}
+STRUCTURAL_FUNCTIONS = {
+    'nth-child': (False, False),
+    'nth-last-child': (True, False),
+    'nth-of-type': (False, True),
+    'nth-last-of-type': (True, True),
+}
+
+
+def split_classes(value):
+    return [name for name in CLASS_SEPARATOR_RE.split(value) if name]
+
+
+def compile_plan(selector, lower_case=False):
+    """Return a list of :class:`Branch`, one per group of ``selector``, or
+    None if the selector is not made only of tag, id, class, attribute,
+    ``:contains()`` and ``:nth-child()`` like parts::
+
+        >>> compile_plan('div#main.a.b, li[title^=x]:nth-child(2n+1)')
+        [Branch(tag='div', id='main', classes=('b', 'a'), attributes=(), \
+texts=(), positions=()), Branch(tag='li', id=None, classes=(), \
+attributes=(('title', '^=', 'x'),), texts=(), \
+positions=((2, 1, False, False),))]
+        >>> compile_plan('div a') is None
+        True
+
+    Element and attribute names are lower cased if lower_case is true, like
+    cssselect's HTMLTranslator does.
+    """
+    key = (selector, lower_case)
+    plan = plan_cache.get(key)
+    if plan is None:
+        try:
+            plan = [_compile_simple(s, lower_case) for s in parse(selector)]
+        except (SelectorError, ValueError):
+            plan = [None]
+        if None in plan:
+            plan = False
+        plan_cache[key] = plan
+    return plan or None
+
+
+def _compile_simple(selector, lower_case):
+    if selector.pseudo_element is not None:
+        return None
+    return _compile_compound(selector.parsed_tree, lower_case)
+
+
+def _compile_compound(tree, lower_case):
+    id = None
+    classes = []
+    attributes = []
+    texts = []
+    positions = []
+    while isinstance(tree, (Class, Hash, Attrib, Function, Pseudo)):
+        if isinstance(tree, Class):
+            classes.append(tree.class_name)
+        elif isinstance(tree, Attrib):
+            if (tree.namespace is not None or getattr(tree, 'flag', None) or
+                    tree.operator not in ATTRIBUTE_OPERATORS):
+                return None
+            name = tree.attrib.lower() if lower_case else tree.attrib
+            value = None if tree.value is None else tree.value.value
+            attributes.append((name, tree.operator, value))
+        elif isinstance(tree, Pseudo):
+            if tree.ident not in STRUCTURAL_PSEUDOS:
+                return None
+            positions.extend(STRUCTURAL_PSEUDOS[tree.ident])
+        elif isinstance(tree, Function):
+            if tree.name in STRUCTURAL_FUNCTIONS:
+                a, b = parse_series(tree.arguments)
+                positions.append((a, b) + STRUCTURAL_FUNCTIONS[tree.name])
+            elif (tree.name == 'contains' and
+                    tree.argument_types() in (['STRING'], ['IDENT'])):
+                texts.append(tree.arguments[0].value)
+            else:
+                return None
+        elif id is None or id == tree.id:
+            id = tree.id
+        else:
+            return None
+        tree = tree.selector
+    if not isinstance(tree, Element) or tree.namespace is not None:
+        return None
+    tag = tree.element
+    if tag is not None and lower_case:
+        tag = tag.lower()
+    if tag is None and any(of_type for a, b, end, of_type in positions):
+        # not supported by cssselect either
+        return None
+    return Branch(tag, id, tuple(classes), tuple(attributes), tuple(texts),
+                  tuple(positions))
+
+
+def compile_matcher(selector, lower_case=False):
+    """Return a function telling if an element matches selector, or None if
+    the selector is not made only of tag, id, class, attribute and
+    ``:contains()`` parts::
+
+        >>> from lxml import etree
+        >>> match = compile_matcher('a.ext[href^=http], b')
+        >>> match(etree.fromstring('<a class="ext" href="http://x"/>'))
+        True
+        >>> match(etree.fromstring('<a class="ext" href="/x"/>'))
+        False
+
+    """
+    plan = compile_plan(selector, lower_case)
+    if plan is None or any(branch.positions for branch in plan):
+        return None
+    if len(plan) == 1:
+        branch = plan[0]
+        return lambda element: _matches(element, *branch[:5])
+    return lambda element: any(_matches(element, *branch[:5])
+                               for branch in plan)
+
+
+def compile_chains(selector, lower_case=False):
+    """Return a list of chains, one per group of ``selector``, or None if
+    the selector is not made of parts supported by :func:`compile_matcher`
+    joined by descendant or child combinators. A chain is a list of
+    ``(combinator, branch)`` from the leftmost compound selector, where
+    combinator joins branch to the previous one (None for the first)::
+
+        >>> [[(combinator, branch.tag) for combinator, branch in chain]
+        ...  for chain in compile_chains('ul > li a, p')]
+        [[(None, 'ul'), ('>', 'li'), (' ', 'a')], [(None, 'p')]]
+        >>> compile_chains('ul ~ li') is None
+        True
+
+    """
+    key = (selector, lower_case)
+    chains = chain_cache.get(key)
+    if chains is None:
+        try:
+            chains = [_compile_chain(s, lower_case) for s in parse(selector)]
+        except (SelectorError, ValueError):
+            chains = [None]
+        if None in chains:
+            chains = False
+        chain_cache[key] = chains
+    return chains or None
+
+
+def _compile_chain(selector, lower_case):
+    if selector.pseudo_element is not None:
+        return None
+    chain = []
+    tree = selector.parsed_tree
+    while isinstance(tree, CombinedSelector):
+        if tree.combinator not in (' ', '>'):
+            return None
+        chain.append((tree.combinator,
+                      _compile_compound(tree.subselector, lower_case)))
+        tree = tree.selector
+    chain.append((None, _compile_compound(tree, lower_case)))
+    if any(branch is None or branch.positions for _, branch in chain):
+        return None
+    return chain[::-1]
+
+
+def _branch_key(branch):
+    """Return the key of the elements branch can match: one of their id,
+    class or tag name"""
+    if branch.id is not None:
+        return ('id', branch.id)
+    if branch.classes:
+        return ('class', branch.classes[0])
+    return ('tag', branch.tag)
+
+
+class _Step:
+    __slots__ = ('classes', 'combinator', 'exact', 'id', 'key', 'next',
+                 'rest', 'selector', 'tag')
+
+    def __init__(self, selector, branch, next):
+        self.selector = selector
+        self.tag, self.id = branch.tag, branch.id
+        self.classes = frozenset(branch.classes)
+        # attributes and texts
+        self.rest = None
+        if branch.attributes or branch.texts:
+            self.rest = (None, None, (), branch.attributes, branch.texts)
+        self.key = _branch_key(branch)
+        # branches made only of their key need no further check
+        self.exact = (not self.rest and
+                      (branch.tag is not None) + (branch.id is not None) +
+                      len(branch.classes) < 2)
+        # how the elements matching next relate to the ones matching self
+        self.combinator = next and next[0]
+        self.next = next and next[1]
+
+
+class ChainMatcher:
+    """Match several selectors compiled by :func:`compile_chains` during a
+    single walk of a tree::
+
+        >>> from lxml import etree
+        >>> root = etree.fromstring('<ul><li><a/></li><li/></ul>')
+        >>> matcher = ChainMatcher({'ul > li': compile_chains('ul > li'),
+        ...                         'li a, ul': compile_chains('li a, ul')})
+        >>> found = matcher.match([root])
+        >>> [e.tag for e in found['ul > li']]
+        ['li', 'li']
+        >>> [e.tag for e in found['li a, ul']]
+        ['ul', 'a']
+
+    Chains are matched from left to right. An element matching a part of a
+    chain makes its children (for ``>``) or all its descendants look for
+    the next part. Parts are looked up by the id, classes and tag
+    of each element, so that the cost of an element does not depend on the
+    number of selectors which can't match it.
+    """
+
+    def __init__(self, chains):
+        self.selectors = list(chains)
+        self.starts = {}
+        for selector, alternatives in chains.items():
+            for chain in alternatives:
+                step = next = None
+                for combinator, branch in reversed(chain):
+                    step = _Step(selector, branch, next)
+                    next = (combinator, step)
+                self.starts.setdefault(step.key, {})[step] = None
+
+    def match(self, roots):
+        """Return a dict mapping selectors to the elements matching them in
+        the subtrees of roots, in document order. roots must be disjoint and
+        in document order"""
+        results = {selector: [] for selector in self.selectors}
+        for selector, element in self.iter(roots):
+            results[selector].append(element)
+        return results
+
+    def iter(self, roots):
+        """Yield ``(selector, element)`` for each element matching a
+        selector in the subtrees of roots as the tree is walked"""
+        starts = self.starts
+        universal = ('tag', None)
+        for root in roots:
+            stack = []
+            # steps matched by the children of the current element and by
+            # all its descendants
+            children = descendants = {}
+            for event, element in etree.iterwalk(
+                    root, events=('start', 'end')):
+                if event == 'end':
+                    children, descendants = stack.pop()
+                    continue
+                tag = element.tag
+                keys = [universal, ('tag', tag)]
+                id = element.get('id')
+                if id is not None:
+                    keys.append(('id', id))
+                value = element.get('class')
+                names = set(split_classes(value)) if value else ()
+                keys.extend(('class', name) for name in names)
+                matched = set()
+                new_children = {}
+                new_descendants = None
+                for steps in (starts, children, descendants):
+                    if not steps:
+                        continue
+                    for key in keys:
+                        for step in steps.get(key, ()):
+                            if not step.exact and (
+                                    step.tag is not None and step.tag != tag
+                                    or step.id is not None and step.id != id
+                                    or not step.classes.issubset(names)
+                                    or step.rest and not _matches(
+                                        element, *step.rest)):
+                                continue
+                            next = step.next
+                            if next is None:
+                                matched.add(step.selector)
+                            elif step.combinator == '>':
+                                new_children.setdefault(
+                                    next.key, {})[next] = None
+                            elif next not in descendants.get(next.key, ()):
+                                if new_descendants is None:
+                                    new_descendants = {
+                                        k: dict(v)
+                                        for k, v in descendants.items()}
+                                new_descendants.setdefault(
+                                    next.key, {})[next] = None
+                stack.append((children, descendants))
+                children = new_children
+                if new_descendants is not None:
+                    descendants = new_descendants
+                for selector in matched:
+                    yield selector, element
+
+
+# indexes of indexed documents, by root element. Entries are dropped with
+# the last PyQuery object holding the index
+indexes = WeakValueDictionary()
+
+
+def _root(element):
+    try:
+        return element.getroottree().getroot()
+    except AttributeError:
+        # strings and other non element values
+        return None
+
+
+def document_root(elements):
+    """Return the root element of the document of the first element of
+    elements, or None"""
+    for element in elements:
+        root = _root(element)
+        if root is not None:
+            return root
+
+
+def document_index(elements, create=False):
+    """Return the index of the document of elements. If there is none, a
+    new index is attached to the document when create is true, otherwise
+    None is returned"""
+    if not create and not indexes:
+        return None
+    root = document_root(elements)
+    if root is None:
+        return DocumentIndex() if create else None
+    index = indexes.get(root)
+    if index is None and create:
+        index = indexes[root] = DocumentIndex(root)
+    return index
+
+
+def invalidate_indexes(elements):
+    """Invalidate the indexes of the documents of elements"""
+    if not indexes:
+        return
+    for root in {_root(element) for element in elements}:
+        index = indexes.get(root)
+        if index is not None:
+            index.invalidate()
+
+
+class DocumentIndex:
+    """Lookup tables of elements by id, class and tag name. Tables are
+    built in one walk of the document the first time they are needed and
+    dropped by :meth:`invalidate`.
+
+    The text of the document is indexed separately, the first time a
+    ``:contains()`` selector or :meth:`search` needs it: all text nodes are
+    concatenated in document order and each element is mapped to the range
+    of its own text. The elements containing a string are the innermost
+    elements containing its occurrences and their ancestors.
+
+    Positions of elements among their siblings are computed once per parent,
+    when ``:nth-child()`` like selectors or :meth:`sibling_position` need
+    them. ``text_summaries`` caches the texts extracted by
+    :meth:`~pyquery.pyquery.PyQuery.texts`, by options.
+
+    Indexes are bound to the root element of their document (see
+    :func:`document_index`) and are not used for elements of other
+    documents. The manipulation methods of any
+    :class:`~pyquery.pyquery.PyQuery` object invalidate the indexes of the
+    documents they modify. Call :meth:`invalidate` or
+    :func:`invalidate_indexes` after modifying the tree with the lxml API.
+    """
+
+    def __init__(self, document=None):
+        self.document = document
+        self.invalidate()
+
+    def holds(self, element):
+        """Tell if element is in the indexed document"""
+        return self.document is not None and _root(element) is self.document
+
+    def invalidate(self):
+        self.root = None
+        self.positions = self.ends = None
+        self.ids = self.classes = self.tags = self.elements = None
+        self.text = self.text_ranges = self.text_starts = None
+        self.occurrences = LRUCache(maxsize=128)
+        self.siblings = {}
+        self.text_summaries = {}
+
+    def build(self, root):
+        positions = {}
+        ends = {}
+        ids = {}
+        classes = {}
+        tags = {}
+        elements = ([], [])
+        count = 0
+        for event, el in etree.iterwalk(root, events=('start', 'end')):
+            if event == 'end':
+                ends[el] = count
+                continue
+            positions[el] = count
+            elements[0].append(count)
+            elements[1].append(el)
+            for table, key in ((tags, el.tag), (ids, el.get('id'))):
+                if key is not None:
+                    entry = table.get(key)
+                    if entry is None:
+                        entry = table[key] = ([], [])
+                    entry[0].append(count)
+                    entry[1].append(el)
+            value = el.get('class')
+            if value:
+                for name in set(split_classes(value)):
+                    entry = classes.get(name)
+                    if entry is None:
+                        entry = classes[name] = ([], [])
+                    entry[0].append(count)
+                    entry[1].append(el)
+            count += 1
+        self.root = root
+        self.positions, self.ends = positions, ends
+        self.ids, self.classes, self.tags = ids, classes, tags
+        self.elements = elements
+
+    def build_text(self, root):
+        parts = []
+        length = 0
+        ranges = {}
+        starts = ([], [])
+        for event, node in etree.iterwalk(
+                root, events=('start', 'end', 'comment', 'pi')):
+            if event == 'start':
+                ranges[node] = length
+                starts[0].append(length)
+                starts[1].append(node)
+                text = node.text
+            elif node is root:
+                ranges[node] = (ranges[node], length)
+                break
+            else:
+                if event == 'end':
+                    ranges[node] = (ranges[node], length)
+                text = node.tail
+            if text:
+                parts.append(text)
+                length += len(text)
+        self.text = ''.join(parts)
+        self.text_ranges, self.text_starts = ranges, starts
+        self.occurrences.clear()
+
+    def find_text(self, text):
+        """Return the sorted offsets of text in the text of the document"""
+        offsets = []
+        if text:
+            find = self.text.find
+            offset = find(text)
+            while offset != -1:
+                offsets.append(offset)
+                offset = find(text, offset + 1)
+        return offsets
+
+    def _innermost(self, offset, size):
+        """Return the innermost element containing the text from offset to
+        offset + size"""
+        ranges = self.text_ranges
+        starts, nodes = self.text_starts
+        # the last element starting before offset or the closest of its
+        # ancestors ending after the text
+        node = nodes[bisect_right(starts, offset) - 1]
+        while ranges[node][1] < offset + size:
+            node = node.getparent()
+        return node
+
+    def containing(self, text):
+        """Return the set of elements containing text, like XPath's
+        ``contains(., text)``"""
+        elements = self.occurrences.get(text)
+        if elements is None:
+            if not text:
+                elements = set(self.text_ranges)
+            else:
+                elements = set()
+                for offset in self.find_text(text):
+                    node = self._innermost(offset, len(text))
+                    # stop at ancestors already added for another occurrence
+                    while node is not None and node not in elements:
+                        elements.add(node)
+                        node = node.getparent()
+            self.occurrences[text] = elements
+        return elements
+
+    def search(self, text, elements):
+        """Return the innermost elements containing each occurrence of
+        text in the subtrees of elements, in document order, or None if
+        elements are not in the indexed document"""
+        if self.document is None:
+            return None
+        if self.root is None:
+            self.build(self.document)
+        if self.text is None:
+            self.build_text(self.root)
+        ranges = self.text_ranges
+        try:
+            scopes = sorted(ranges[e] for e in elements)
+        except KeyError:
+            return None
+        # ranges are nested or disjoint. Drop nested ones
+        disjoint = []
+        for start, end in scopes:
+            if not disjoint or start >= disjoint[-1][1]:
+                disjoint.append((start, end))
+        scope_starts = [start for start, end in disjoint]
+        size = len(text)
+        results = {}
+        for offset in self.find_text(text):
+            i = bisect_right(scope_starts, offset) - 1
+            if i >= 0 and offset + size <= disjoint[i][1]:
+                results[self._innermost(offset, size)] = None
+        return sorted(results, key=self.positions.__getitem__)
+
+    def sibling_position(self, element):
+        """Return the position of element among the elements of its parent,
+        the position among elements of the same tag, the number of elements
+        and the number of elements of the same tag. Positions are cached
+        for the elements of the indexed document only"""
+        parent = element.getparent()
+        if parent is None:
+            return 0, 0, 1, 1
+        cache = self.holds(element)
+        entry = self.siblings.get(parent) if cache else None
+        if entry is None:
+            positions = {}
+            counts = {}
+            count = 0
+            for child in parent:
+                tag = child.tag
+                if isinstance(tag, str):
+                    of_type = counts.get(tag, 0)
+                    positions[child] = (count, of_type)
+                    counts[tag] = of_type + 1
+                    count += 1
+            entry = (positions, counts, count)
+            if cache:
+                self.siblings[parent] = entry
+        positions, counts, count = entry
+        position, of_type = positions[element]
+        return position, of_type, count, counts[element.tag]
+
+    def nth_matches(self, element, positions):
+        """Tell if element matches all the (a, b, from_end, of_type)
+        constraints of ``:nth-child()`` like selectors"""
+        position, of_type, count, type_count = self.sibling_position(element)
+        for a, b, from_end, by_type in positions:
+            if by_type:
+                index = type_count - of_type if from_end else of_type + 1
+            else:
+                index = count - position if from_end else position + 1
+            if a == 0:
+                if index != b:
+                    return False
+            elif (index - b) % a or (index - b) // a < 0:
+                return False
+        return True
+
+    def select(self, selector, elements, axis, lower_case=False):
+        """Return the elements matching selector along axis
+        (``descendant-or-self::``, ``descendant::`` or ``self::``) from
+        elements, or None if the index can not be used"""
+        plan = compile_plan(selector, lower_case)
+        if plan is None or not elements or self.document is None:
+            return None
+        if axis == 'self::':
+            # structural selectors on elements of other documents are
+            # evaluated with XPath
+            if (any(branch.positions for branch in plan) and
+                    not all(self.holds(e) for e in elements)):
+                return None
+            return [e for e in elements
+                    if isinstance(e, etree._Element) and
+                    any(_matches(e, *branch[:5]) and
+                        self.nth_matches(e, branch.positions)
+                        for branch in plan)]
+        if self.root is None:
+            self.build(self.document)
+        positions, ends = self.positions, self.ends
+        ranges = []
+        for e in elements:
+            try:
+                start = positions[e]
+            except (KeyError, TypeError):
+                return None
+            if axis == 'descendant::':
+                start += 1
+            ranges.append((start, ends[e]))
+        ranges.sort()
+        # subtrees are nested or disjoint. Drop nested ones
+        disjoint = []
+        for start, end in ranges:
+            if not disjoint or start >= disjoint[-1][1]:
+                disjoint.append((start, end))
+        if self.text is None and any(branch.texts for branch in plan):
+            self.build_text(self.root)
+        results = []
+        for tag, id, classes, attributes, texts, nth in plan:
+            candidates = self._candidates(tag, id, classes)
+            if candidates is None:
+                continue
+            offsets, matches = candidates
+            # candidates of a single part selector need no further check
+            check = ((tag is not None) + (id is not None) + len(classes) > 1
+                     or attributes)
+            for start, end in disjoint:
+                lo = bisect_left(offsets, start)
+                hi = bisect_left(offsets, end, lo)
+                if check:
+                    found = [e for e in matches[lo:hi]
+                             if _matches(e, tag, id, classes, attributes)]
+                else:
+                    found = matches[lo:hi]
+                for text in texts:
+                    containing = self.containing(text)
+                    found = [e for e in found if e in containing]
+                if nth:
+                    found = [e for e in found if self.nth_matches(e, nth)]
+                results.extend(found)
+        if len(plan) > 1:
+            results = sorted(set(results), key=positions.__getitem__)
+        return results
+
+    def _candidates(self, tag, id, classes):
+        tables = []
+        if id is not None:
+            tables.append(self.ids.get(id))
+        tables.extend(self.classes.get(name) for name in classes)
+        if tag is not None:
+            tables.append(self.tags.get(tag))
+        if None in tables:
+            return None
+        if not tables:
+            return self.elements
+        return min(tables, key=lambda table: len(table[0]))
+
+
+def _matches(element, tag, id, classes, attributes=(), texts=()):
+    if tag is None:
+        if not isinstance(element.tag, str):
+            return False
+    elif element.tag != tag:
+        return False
+    if id is not None and element.get('id') != id:
+        return False
+    if classes:
+        value = element.get('class')
+        # substrings are cheaper to look for than names
+        if not value or not all(name in value for name in classes):
+            return False
+        names = split_classes(value)
+        if not all(name in names for name in classes):
+            return False
+    for name, operator, value in attributes:
+        if not _matches_attribute(element.get(name), operator, value):
+            return False
+    if texts:
+        value = ''.join(element.itertext())
+        return all(text in value for text in texts)
+    return True
+
+
+def _matches_attribute(actual, operator, value):
+    """Match an attribute value like cssselect's XPath expressions"""
+    if operator == 'exists':
+        return actual is not None
+    if operator == '!=':
+        return actual != value if value else bool(actual)
+    if actual is None:
+        return False
+    if operator == '=':
+        return actual == value
+    if operator == '|=':
+        return actual == value or actual.startswith(value + '-')
+    if not value:
+        return False
+    if operator == '~=':
+        return (not WHITESPACE_RE.search(value) and
+                value in split_classes(actual))
+    if operator == '^=':
+        return actual.startswith(value)
+    if operator == '$=':
+        return actual.endswith(value)
+    return value in actual
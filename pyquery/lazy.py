@@ -0,0 +1,224 @@
+# Copyright (C) 2008 - Olivier Lauzanne <olauzanne@gmail.com>
+#
+# Distributed under the BSD license, see LICENSE.txt
+from cssselect import SelectorError
+from cssselect import parse as parse_selector
+from cssselect.parser import CombinedSelector
+
+from .pyquery import document_order, is_positional
+
+# siblings as returned by getnext() / getprevious()
+NEXT = 'following-sibling::node()[not(self::text())]'
+PREVIOUS = 'preceding-sibling::node()[not(self::text())]'
+
+
+class LazyQuery:
+    """A chain of traversal methods recorded on a
+    :class:`~pyquery.pyquery.PyQuery` object and evaluated only when its
+    result is needed::
+
+        >>> from pyquery import PyQuery
+        >>> d = PyQuery('<div><p class="a"><b>1</b></p><p><b>2</b></p></div>')
+        >>> chain = d.lazy()('p').filter('.a').find('b')
+        >>> chain.xpath  # doctest: +ELLIPSIS
+        "self::node()/descendant-or-self::p/self::node()[...]/descendant::b"
+        >>> chain
+        [<b>]
+        >>> chain.end().end()
+        [<p.a>, <p>]
+
+    Consecutive steps are merged in one XPath expression. Steps which can't
+    be expressed in XPath (like callable filters or ``eq()``) are applied on
+    the evaluated result of the previous steps. Results are unique and in
+    document order. Other attributes are looked up on the evaluated
+    :class:`~pyquery.pyquery.PyQuery` object.
+    """
+
+    def __init__(self, base, source, parent, xpath=None, method=None,
+                 union=False):
+        self._base = base
+        self._source = source
+        self.xpath = xpath
+        self._method = method
+        self._union = union
+        self._parent = parent
+        self._result = None
+        self._translator = base._translator
+        self._index = base._index
+        self.namespaces = base.namespaces
+
+    @property
+    def base_url(self):
+        return self._base.base_url
+
+    def evaluate(self):
+        """Return the result of the chain as a PyQuery object"""
+        if self._result is None:
+            source = self._source
+            if isinstance(source, LazyQuery):
+                source = source.evaluate()
+            if self._method is not None:
+                self._result = self._method(source)
+            else:
+                xpath = self._base._xpath(self.xpath)
+                results = []
+                for tag in source:
+                    if isinstance(tag.tag, str):
+                        results.extend(xpath(tag))
+                    else:
+                        # compiled expressions only accept elements
+                        results.extend(tag.xpath(
+                            self.xpath, namespaces=self.namespaces))
+                if len(source) > 1:
+                    results = document_order(results)
+                self._result = self._base._copy(results, parent=self._parent)
+        return self._result
+
+    ############
+    # Planning #
+    ############
+
+    def _path(self):
+        """Return the expression steps can be appended to and the source it
+        applies to"""
+        if self._method is not None:
+            return 'self::node()', self
+        if self._union:
+            return f'({self.xpath})', self._source
+        return self.xpath, self._source
+
+    def _then(self, step):
+        path, source = self._path()
+        return LazyQuery(self._base, source, self, xpath=f'{path}/{step}')
+
+    def _call(self, name, *args):
+        return LazyQuery(self._base, self, self,
+                         method=lambda d: getattr(d, name)(*args))
+
+    def _predicate(self, selector):
+        """Return an XPath predicate matching selector on the context node
+        or None if selector can not be expressed as a predicate"""
+        try:
+            if any(isinstance(s.parsed_tree, CombinedSelector)
+                   for s in parse_selector(selector)):
+                return None
+        except SelectorError:
+            return None
+        predicate = self._base._css_to_xpath(selector, 'self::')
+        if not is_positional(predicate):
+            return predicate
+
+    def _axis(self, name, step, selector):
+        if selector is None:
+            return self._then(step)
+        predicate = self._predicate(selector)
+        if predicate is None:
+            return self._call(name, selector)
+        return self._then(f'{step}[{predicate}]')
+
+    def _select(self, name, selector, axis):
+        path, source = self._path()
+        xpath = self._base._css_to_xpath(selector, f'{path}/{axis}')
+        if is_positional(xpath):
+            return self._call(name, selector)
+        return LazyQuery(self._base, source, self, xpath=xpath,
+                         union=' | ' in xpath)
+
+    #############
+    # Traversal #
+    #############
+
+    def __call__(self, selector):
+        if not isinstance(selector, str) or selector.startswith('<'):
+            return self.evaluate()(selector)
+        return self._select('__call__', selector, 'descendant-or-self::')
+
+    def find(self, selector):
+        return self._select('find', selector, 'descendant::')
+
+    def filter(self, selector):
+        if callable(selector):
+            return self._call('filter', selector)
+        return self._axis('filter', 'self::node()', selector)
+
+    def not_(self, selector):
+        predicate = self._predicate(selector)
+        if predicate is None:
+            return self._call('not_', selector)
+        return self._then(f'self::node()[not({predicate})]')
+
+    def children(self, selector=None):
+        if selector is None:
+            return self._then('node()[not(self::text())]')
+        return self._axis('children', '*', selector)
+
+    def parent(self, selector=None):
+        return self._axis('parent', 'parent::*', selector)
+
+    def parents(self, selector=None):
+        return self._axis('parents', 'ancestor::*', selector)
+
+    def next(self, selector=None):
+        return self._axis('next', f'{NEXT}[1]', selector)
+
+    def prev(self, selector=None):
+        return self._axis('prev', f'{PREVIOUS}[1]', selector)
+
+    def next_all(self, selector=None):
+        return self._axis('next_all', NEXT, selector)
+
+    def prev_all(self, selector=None):
+        return self._axis('prev_all', PREVIOUS, selector)
+
+    nextAll = next_all
+    prevAll = prev_all
+
+    def siblings(self, selector=None):
+        if selector is None:
+            predicate = ''
+        else:
+            predicate = self._predicate(selector)
+            if predicate is None:
+                return self._call('siblings', selector)
+            predicate = f'[{predicate}]'
+        path, source = self._path()
+        xpath = f'{path}/{PREVIOUS}{predicate} | {path}/{NEXT}{predicate}'
+        return LazyQuery(self._base, source, self, xpath=xpath, union=True)
+
+    def eq(self, index):
+        return self._call('eq', index)
+
+    def end(self):
+        return self._parent
+
+    ##############
+    # Evaluation #
+    ##############
+
+    def __iter__(self):
+        return iter(self.evaluate())
+
+    def __len__(self):
+        return len(self.evaluate())
+
+    def __bool__(self):
+        return bool(self.evaluate())
+
+    def __getitem__(self, index):
+        return self.evaluate()[index]
+
+    def __eq__(self, other):
+        return self.evaluate() == other
+
+    def __str__(self):
+        return str(self.evaluate())
+
+    def __html__(self):
+        return self.evaluate().__html__()
+
+    def __repr__(self):
+        return repr(self.evaluate())
+
+    def __getattr__(self, name):
+        return getattr(self.evaluate(), name)
+
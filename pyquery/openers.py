@@ -1,6 +1,13 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict, namedtuple
+from threading import Lock
 from urllib.error import HTTPError
 from urllib.parse import urlencode
-from urllib.request import urlopen
+from urllib.request import Request, urlopen
 
 try:
     import requests
@@ -17,6 +24,16 @@ allowed_args = (
     'cert', 'config', 'hooks', 'proxies', 'cookies'
 )
 
+CacheInfo = namedtuple(
+    'CacheInfo',
+    ['hits', 'misses', 'revalidations', 'maxsize', 'currsize'])
+
+# cache used by url_opener when no cache argument is given
+default_cache = None
+
+# responses depending on these arguments are not cached
+uncached_args = ('auth', 'cookies', 'session', 'cert')
+
 
 def _query(url, method, kwargs):
     data = None
@@ -39,7 +56,7 @@ def _query(url, method, kwargs):
     return url, data
 
 
-def _requests(url, kwargs):
+def _requests_response(url, kwargs):
 
     encoding = kwargs.get('encoding')
     method = kwargs.get('method', 'get').lower()
@@ -60,17 +77,245 @@ def _requests(url, kwargs):
                         resp.reason, resp.headers, None)
     if encoding:
         resp.encoding = encoding
-    html = resp.text
-    return html
+    return resp.text, resp.headers
+
+
+def _requests(url, kwargs):
+    return _requests_response(url, kwargs)[0]
 
 
 def _urllib(url, kwargs):
     method = kwargs.get('method')
     url, data = _query(url, method, kwargs)
-    return urlopen(url, data, timeout=kwargs.get('timeout', DEFAULT_TIMEOUT))
+    request = Request(url, data, headers=kwargs.get('headers') or {})
+    return urlopen(request,
+                   timeout=kwargs.get('timeout', DEFAULT_TIMEOUT))
+
+
+def _urllib_response(url, kwargs):
+    with _urllib(url, kwargs) as resp:
+        return resp.read(), resp.headers
+
+
+class ResponseCache:
+    """Base class of the caches used by :func:`url_opener` for GET
+    requests. Entries younger than ``ttl`` seconds are used as is. Older
+    ones are revalidated with ``If-None-Match`` / ``If-Modified-Since``
+    headers. ``maxsize`` is the size of the stored bodies, in bytes or
+    characters.
+
+    Entries are keyed by url, request headers and encoding. Requests with
+    ``auth``, ``cookies``, ``session`` or ``cert`` arguments are not cached.
+
+    Subclasses implement :meth:`get`, :meth:`set`, :meth:`clear` and
+    ``currsize``.
+    """
+
+    def __init__(self, maxsize, ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = self.revalidations = 0
+        self._lock = Lock()
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, key):
+        raise NotImplementedError()
+
+    def set(self, key, entry):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def info(self):
+        """Return hits, misses, revalidations, maxsize and currsize as a
+        named tuple"""
+        return CacheInfo(self.hits, self.misses, self.revalidations,
+                         self.maxsize, self.currsize)
+
+    def open(self, url, kwargs, opener):
+        """Return the body of url, using opener(url, kwargs) to get a
+        ``(body, headers)`` tuple when the cached entry is missing or
+        stale"""
+        url, _data = _query(url, 'get', dict(kwargs))
+        kwargs = dict(kwargs, data=None)
+        if any(kwargs.get(name) for name in uncached_args):
+            return opener(url, kwargs)[0]
+        key = url
+        headers = kwargs.get('headers') or {}
+        encoding = kwargs.get('encoding')
+        if headers or encoding:
+            key = json.dumps([url, sorted(headers.items()), encoding],
+                             default=str)
+        entry = self.get(key)
+        now = time.time()
+        if entry is not None and now - entry['time'] < self.ttl:
+            self._count('hits')
+            return entry['body']
+        if entry is not None:
+            headers = dict(headers)
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+            kwargs['headers'] = headers
+        try:
+            body, headers = opener(url, kwargs)
+        except HTTPError as e:
+            if entry is None or e.code != 304:
+                raise
+            self._count('revalidations')
+            entry['time'] = now
+            self.set(key, entry)
+            return entry['body']
+        self._count('misses')
+        self.set(key, {
+            'body': body,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'time': now,
+        })
+        return body
+
+
+class MemoryCache(ResponseCache):
+    """In memory LRU response cache"""
+
+    def __init__(self, maxsize=32 * 1024 * 1024, ttl=0):
+        super().__init__(maxsize, ttl)
+        self._entries = OrderedDict()
+        self.currsize = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return dict(entry)
+
+    def set(self, key, entry):
+        size = len(entry['body'])
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.currsize -= len(old['body'])
+            if size > self.maxsize:
+                return
+            self._entries[key] = entry
+            self.currsize += size
+            while self.currsize > self.maxsize:
+                _key, old = self._entries.popitem(last=False)
+                self.currsize -= len(old['body'])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.currsize = 0
+
+
+class FileCache(ResponseCache):
+    """On disk response cache. Each entry is a file in ``directory``. The
+    least recently used ones are removed when the total size of the
+    directory goes over ``maxsize`` bytes.
+
+    The size of the directory is computed when the cache is created and
+    then kept up to date by :meth:`set`. The directory is only scanned
+    again to remove entries.
+    """
+
+    def __init__(self, directory, maxsize=256 * 1024 * 1024, ttl=0):
+        super().__init__(maxsize, ttl)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.currsize = sum(e.stat().st_size for e in self._files())
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.cache')
+
+    def _files(self):
+        return [e for e in os.scandir(self.directory)
+                if e.name.endswith('.cache')]
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fd:
+                meta = json.loads(fd.readline())
+                body = fd.read()
+            # keep track of usage for eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        if meta.pop('text'):
+            body = body.decode('utf-8')
+        meta['body'] = body
+        return meta
+
+    def set(self, key, entry):
+        body = entry['body']
+        meta = {k: v for k, v in entry.items() if k != 'body'}
+        meta['text'] = isinstance(body, str)
+        if meta['text']:
+            body = body.encode('utf-8')
+        path = self._path(key)
+        # unique per process and thread
+        handle, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with open(handle, 'wb') as fd:
+            fd.write(json.dumps(meta).encode('utf-8') + b'\n')
+            fd.write(body)
+            size = fd.tell()
+        with self._lock:
+            # the size of the file actually replaced
+            try:
+                size -= os.stat(path).st_size
+            except OSError:
+                pass
+            os.replace(tmp, path)
+            self.currsize += size
+            if self.currsize > self.maxsize:
+                self._evict()
+
+    def _evict(self):
+        """Remove the least recently used files until the directory fits in
+        maxsize"""
+        files = []
+        for entry in self._files():
+            try:
+                stat = entry.stat()
+            except OSError:
+                # removed by another process
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, file_path in files:
+            if size <= self.maxsize:
+                break
+            size -= file_size
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+        self.currsize = size
+
+    def clear(self):
+        with self._lock:
+            for entry in self._files():
+                os.remove(entry.path)
+            self.currsize = 0
 
 
 def url_opener(url, kwargs):
+    cache = kwargs.get('cache', default_cache)
+    method = kwargs.get('method') or 'get'
+    if cache is not None and str(method).lower() == 'get':
+        if HAS_REQUEST:
+            return cache.open(url, kwargs, _requests_response)
+        return cache.open(url, kwargs, _urllib_response)
     if HAS_REQUEST:
         return _requests(url, kwargs)
     return _urllib(url, kwargs)
@@ -1,21 +1,39 @@
 # Copyright (C) 2008 - Olivier Lauzanne <olauzanne@gmail.com>
 #
 # Distributed under the BSD license, see LICENSE.txt
+import asyncio
+import functools
 import inspect
 import itertools
+import os
 import sys
 import types
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from html import escape
 from reprlib import recursive_repr
 from urllib.parse import urlencode, urljoin
 
 import lxml.html
+from cssselect import SelectorError
+from cssselect import parse as parse_selector
+from cssselect.parser import CombinedSelector, Element, Function, Pseudo, Relation
+from cssselect.xpath import ExpressionError
 from lxml import etree
 
+from .cache import LRUCache
 from .cssselectpatch import JQueryTranslator
-from .openers import url_opener
-from .text import extract_text
+from .index import (
+    ChainMatcher,
+    DocumentIndex,
+    compile_chains,
+    compile_matcher,
+    document_index,
+    document_root,
+    invalidate_indexes,
+)
+from .openers import DEFAULT_TIMEOUT, url_opener
+from .text import extract_texts, iter_text, join_chunks
 
 if sys.version_info >= (3, 12, 0):
     from collections import OrderedDict
@@ -36,6 +54,27 @@ else:
 
 basestring = (str, bytes)
 
+# translated selectors, keyed by (translator class, xhtml, selector, prefix)
+css_to_xpath_cache = LRUCache(maxsize=1024)
+
+# compiled etree.XPath objects, keyed by (expression, namespaces)
+xpath_cache = LRUCache(maxsize=1024)
+
+# :has() semi-join plans, keyed like css_to_xpath_cache
+has_plan_cache = LRUCache(maxsize=1024)
+
+# jQuery positional selectors, keyed by selector
+positional_plan_cache = LRUCache(maxsize=1024)
+
+# parsed fragments of the manipulation methods, keyed by (markup, parser).
+# Markup longer than FRAGMENT_CACHE_MAX_LENGTH characters is not cached, so
+# that the cache holds at most 256 small fragments
+fragment_cache = LRUCache(maxsize=256)
+FRAGMENT_CACHE_MAX_LENGTH = 4096
+
+POSITIONAL_PSEUDOS = {'first', 'last', 'even', 'odd'}
+POSITIONAL_FUNCTIONS = {'eq', 'lt', 'gt'}
+
 
 def getargspec(func):
     args = inspect.signature(func).parameters.values()
@@ -113,6 +152,185 @@ def fromstring(context, parser=None, custom_parser=None):
         return []
 
 
+def iter_chunks(source, size=64 * 1024):
+    """Yield chunks of data from a path, a file object, bytes or an iterable
+    of chunks"""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as fd:
+            yield from iter(lambda: fd.read(size), b'')
+    elif isinstance(source, bytes):
+        yield source
+    elif hasattr(source, 'read') and callable(source.read):
+        yield from iter(lambda: source.read(size), source.read(0))
+    else:
+        yield from source
+
+
+def compile_xpath(expression, namespaces=None):
+    """Return a compiled :class:`lxml.etree.XPath` for expression, reusing
+    a previously compiled one if possible"""
+    key = (expression,
+           tuple(sorted(namespaces.items())) if namespaces else None)
+    xpath = xpath_cache.get(key)
+    if xpath is None:
+        xpath = etree.XPath(expression, namespaces=namespaces)
+        xpath_cache[key] = xpath
+    return xpath
+
+
+def document_order_key():
+    """Return a function giving sort keys in document order. Keys are
+    paths of sibling indexes, memoized for ancestors so that elements
+    sharing ancestors are cheap to compare. Paths start with the rank of
+    their root among the roots seen by the function, so that the elements
+    of each tree stay together, in the order the trees are first seen"""
+    keys = {}
+    indexes = {}
+    roots = itertools.count()
+
+    def root_key(root):
+        key = keys.get(root)
+        if key is None:
+            key = keys[root] = (next(roots),)
+        return key
+
+    def sort_key(element):
+        parent = element.getparent()
+        if parent is None:
+            return root_key(element)
+        key = keys.get(parent)
+        if key is None:
+            # walk up to the closest ancestor with a known key
+            chain = [parent]
+            ancestor = parent.getparent()
+            while ancestor is not None and ancestor not in keys:
+                chain.append(ancestor)
+                ancestor = ancestor.getparent()
+            if ancestor is None:
+                ancestor = chain.pop()
+                key = root_key(ancestor)
+            else:
+                key = keys[ancestor]
+            for node in reversed(chain):
+                key += (index_of(ancestor)[node],)
+                keys[node] = key
+                ancestor = node
+        return key + (index_of(parent)[element],)
+
+    def index_of(parent):
+        index = indexes.get(parent)
+        if index is None:
+            index = indexes[parent] = dict(zip(parent, itertools.count()))
+        return index
+    return sort_key
+
+
+def is_positional(xpath):
+    """Tell if an XPath expression depends on the position of nodes in
+    their node-set"""
+    return 'position()' in xpath or 'last()' in xpath
+
+
+def compile_positional_plan(selector):
+    """Return a list of (selector, filters) tuples, one per group of
+    selector, where filters are the jQuery positional pseudo classes ending
+    the group, in the order they apply::
+
+        >>> compile_positional_plan('div > li.a:gt(0):lt(2), p')
+        [('div > li.a', [('gt', 0), ('lt', 2)]), ('p', [])]
+
+    Return None if no group ends with a positional pseudo class.
+    """
+    plan = positional_plan_cache.get(selector)
+    if plan is None:
+        try:
+            plan = _compile_positional_plan(selector) or False
+        except (SelectorError, ValueError):
+            plan = False
+        positional_plan_cache[selector] = plan
+    return plan or None
+
+
+def _compile_positional_plan(selector):
+    plan = []
+    for group in parse_selector(selector):
+        if group.pseudo_element is not None:
+            return None
+        # the compound selector of the matched elements
+        parent, attribute = group, 'parsed_tree'
+        tree = group.parsed_tree
+        while isinstance(tree, CombinedSelector):
+            parent, attribute = tree, 'subselector'
+            tree = tree.subselector
+        filters = []
+        while True:
+            if (isinstance(tree, Pseudo) and
+                    tree.ident in POSITIONAL_PSEUDOS):
+                filters.append((tree.ident, None))
+            elif (isinstance(tree, Function) and
+                    tree.name in POSITIONAL_FUNCTIONS):
+                if tree.argument_types() != ['NUMBER']:
+                    return None
+                filters.append((tree.name, int(tree.arguments[0].value)))
+            else:
+                break
+            tree = tree.selector
+        setattr(parent, attribute, tree)
+        filters.reverse()
+        plan.append((group.canonical(), filters))
+    if any(filters for selector, filters in plan):
+        return plan
+
+
+def slice_positional(elements, name, value=None):
+    """Apply a jQuery positional pseudo class to a list of elements::
+
+        >>> slice_positional(list('abcde'), 'gt', -3)
+        ['d', 'e']
+        >>> slice_positional(list('abcde'), 'eq', -1)
+        ['e']
+
+    """
+    if name == 'first':
+        return elements[:1]
+    if name == 'last':
+        return elements[-1:]
+    if name == 'even':
+        return elements[::2]
+    if name == 'odd':
+        return elements[1::2]
+    if value < 0:
+        value += len(elements)
+    if name == 'eq':
+        return elements[value:value + 1] if value >= 0 else []
+    if name == 'lt':
+        return elements[:max(value, 0)]
+    return elements[max(value + 1, 0):]
+
+
+def document_order(elements):
+    """Return elements without duplicates, sorted in document order"""
+    elements = list(dict.fromkeys(elements))
+    if len(elements) > 1:
+        elements.sort(key=document_order_key())
+    return elements
+
+
+def fragment_fromstring(markup, parser=None):
+    """Return a new ``<root>`` element holding the nodes parsed from markup.
+    Fragments up to ``FRAGMENT_CACHE_MAX_LENGTH`` characters are parsed once
+    and copied from ``fragment_cache``"""
+    if (len(markup) > FRAGMENT_CACHE_MAX_LENGTH or
+            fragment_cache.maxsize <= 0):
+        return fromstring('<root>' + markup + '</root>', parser)[0]
+    key = (markup, parser)
+    root = fragment_cache.get(key)
+    if root is None:
+        root = fragment_cache[key] = fromstring(
+            '<root>' + markup + '</root>', parser)[0]
+    return deepcopy(root)
+
+
 def callback(func, *args):
     return func(*args[:func.__code__.co_argcount])
 
@@ -133,25 +351,37 @@ class FlexibleElement:
         self.pget = pget
         self.pset = pset
         self.pdel = pdel
+        self._element = self._element_class()
+        # set the instance of an element without going through __setattr__
+        self._bind = self._element.__dict__['_element__instance'].__set__
+
+    def _element_class(self):
+        descriptor = self
 
-    def __get__(self, instance, klass):
         class _element:
             """real element to support set/get/del attr and item and js call
             style"""
+            __slots__ = ('__instance',)
+
             def __call__(prop, *args, **kwargs):
-                return self.pget(instance, *args, **kwargs)
+                return descriptor.pget(prop.__instance, *args, **kwargs)
             __getattr__ = __getitem__ = __setattr__ = __setitem__ = __call__
 
             def __delitem__(prop, name):
-                if self.pdel is not no_default:
-                    return self.pdel(instance, name)
+                if descriptor.pdel is not no_default:
+                    return descriptor.pdel(prop.__instance, name)
                 else:
                     raise NotImplementedError()
             __delattr__ = __delitem__
 
             def __repr__(prop):
-                return f'<flexible_element {self.pget.__name__}>'
-        return _element()
+                return f'<flexible_element {descriptor.pget.__name__}>'
+        return _element
+
+    def __get__(self, instance, klass):
+        element = self._element.__new__(self._element)
+        self._bind(element, instance)
+        return element
 
     def __set__(self, instance, value):
         if self.pset is not no_default:
@@ -188,6 +418,12 @@ class PyQuery(list):
 
         self.namespaces = kwargs.pop('namespaces', None)
 
+        indexed = kwargs.pop('indexed', False)
+        if self._parent is not no_default:
+            self._index = self._parent._index
+        else:
+            self._index = None
+
         if kwargs:
             # specific case to get the dom
             if 'filename' in kwargs:
@@ -207,6 +443,7 @@ class PyQuery(list):
                 raise ValueError(f'Invalid keyword arguments {kwargs}')
 
             elements = fromstring(html, self.parser)
+            self._attach_index(elements, indexed)
             # close open descriptor if possible
             if hasattr(html, 'close'):
                 try:
@@ -244,20 +481,251 @@ class PyQuery(list):
             else:
                 raise TypeError(context)
 
+            self._attach_index(elements, indexed)
+
             # select nodes
             if elements and selector is not no_default:
-                xpath = self._css_to_xpath(selector)
-                results = []
-                for tag in elements:
-                    results.extend(
-                        tag.xpath(xpath, namespaces=self.namespaces))
-                elements = results
+                elements = self._select(selector, elements)
 
         list.__init__(self, elements)
 
     def _css_to_xpath(self, selector, prefix='descendant-or-self::'):
-        selector = selector.replace('[@', '[')
-        return self._translator.css_to_xpath(selector, prefix)
+        translator = self._translator
+        key = (translator.__class__, getattr(translator, 'xhtml', None),
+               selector, prefix)
+        xpath = css_to_xpath_cache.get(key)
+        if xpath is None:
+            xpath = translator.css_to_xpath(selector.replace('[@', '['),
+                                            prefix)
+            css_to_xpath_cache[key] = xpath
+        return xpath
+
+    def _xpath(self, expression):
+        return compile_xpath(expression, self.namespaces)
+
+    def _select(self, selector, elements, axis='descendant-or-self::'):
+        """Evaluate selector along axis for all the context elements.
+        Results are unique and in document order.
+        """
+        results = self._index_select(selector, elements, axis)
+        if results is None:
+            results = self._positional_select(selector, elements, axis)
+        if results is None:
+            results = self._has_select(selector, elements, axis)
+        if results is None:
+            xpath = self._xpath(self._css_to_xpath(selector, axis))
+            results = self._evaluate(xpath, elements)
+        return results
+
+    def _evaluate(self, xpath, elements):
+        """Evaluate a compiled expression for all the context elements.
+        Results are unique and in document order.
+        """
+        # compiled expressions only accept elements. Selectors can't match
+        # comments or processing instructions anyway
+        elements = [e for e in elements if isinstance(e.tag, str)]
+        if len(elements) == 1:
+            return xpath(elements[0])
+        results = [e for tag in elements for e in xpath(tag)]
+        # results of disjoint contexts in document order are already sorted
+        keys = list(map(document_order_key(), elements))
+        if all(k1 < k2 and k2[:len(k1)] != k1
+               for k1, k2 in itertools.pairwise(keys)):
+            return results
+        return document_order(results)
+
+    def _positional_select(self, selector, elements, axis):
+        """Evaluate jQuery positional pseudo classes on the elements matched
+        by the rest of the selector for all the context elements, as
+        opposed to XPath's position() which is relative to each context"""
+        plan = compile_positional_plan(selector)
+        if plan is None:
+            return None
+        results = []
+        for base, filters in plan:
+            if axis == 'self::':
+                matches = list(self._filter_only(base, elements))
+            else:
+                matches = list(self._select(base, elements, axis))
+            for name, value in filters:
+                matches = slice_positional(matches, name, value)
+            results.extend(matches)
+        if len(plan) > 1:
+            if axis == 'self::':
+                # keep the order of the filtered elements
+                matched = set(results)
+                results = [e for e in dict.fromkeys(elements)
+                           if e in matched]
+            else:
+                results = document_order(results)
+        return results
+
+    def _has_plan(self, selector, axis):
+        """Return a list of (outer, relations) for each group of selector,
+        where outer is the XPath expression of the group without its
+        ``:has()`` parts and relations a list of (combinator, XPath) lists,
+        one per ``:has()``. Return None if the selector has no ``:has()``
+        or if they can't be evaluated with a semi-join.
+        """
+        translator = self._translator
+        key = (translator.__class__, getattr(translator, 'xhtml', None),
+               selector, axis)
+        plan = has_plan_cache.get(key)
+        if plan is None:
+            try:
+                plan = self._compile_has_plan(selector, axis) or False
+            except (SelectorError, ExpressionError):
+                plan = False
+            has_plan_cache[key] = plan
+        return plan or None
+
+    def _compile_has_plan(self, selector, axis):
+        translator = self._translator
+        plan = []
+        for group in parse_selector(selector.replace('[@', '[')):
+            if group.pseudo_element is not None:
+                return None
+            # remove the :has() of the compound selecting the elements
+            relations = []
+            parent, attribute = group, 'parsed_tree'
+            tree = group.parsed_tree
+            while not isinstance(tree, Element):
+                if isinstance(tree, CombinedSelector):
+                    parent, attribute = tree, 'subselector'
+                elif isinstance(tree, Relation):
+                    relations.append(tree.arguments)
+                    setattr(parent, attribute, tree.selector)
+                else:
+                    parent, attribute = tree, 'selector'
+                tree = getattr(parent, attribute)
+            outer = translator.selector_to_xpath(group, axis)
+            if is_positional(outer):
+                return None
+            compiled = []
+            for arguments in relations:
+                inner = []
+                for combinator, subselector in arguments:
+                    # matches of a compound selector below the contexts are
+                    # the matches below each candidate
+                    if (combinator.value not in (' ', '>') or
+                            subselector.pseudo_element is not None or
+                            isinstance(subselector.parsed_tree,
+                                       CombinedSelector)):
+                        return None
+                    xpath = translator.selector_to_xpath(
+                        subselector, 'descendant::')
+                    if is_positional(xpath):
+                        return None
+                    inner.append((combinator.value, xpath))
+                compiled.append(inner)
+            plan.append((outer, compiled))
+        if any(relations for outer, relations in plan):
+            return plan
+
+    def _has_select(self, selector, elements, axis):
+        """Evaluate :has() by matching its selector once below the contexts
+        and keeping the candidates which are parents (or ancestors) of a
+        match"""
+        plan = self._has_plan(selector, axis)
+        if plan is None:
+            return None
+        results = []
+        for outer, relations in plan:
+            marked = None
+            for inner in relations:
+                marks = set()
+                for combinator, xpath in inner:
+                    matches = self._evaluate(self._xpath(xpath), elements)
+                    if combinator == '>':
+                        marks.update(e.getparent() for e in matches)
+                        continue
+                    for e in matches:
+                        e = e.getparent()
+                        while e is not None and e not in marks:
+                            marks.add(e)
+                            e = e.getparent()
+                marked = marks if marked is None else marked & marks
+            xpath = self._xpath(outer)
+            if axis == 'self::':
+                # keep the order of the filtered elements
+                matches = [e for tag in elements if isinstance(tag.tag, str)
+                           for e in xpath(tag)]
+            else:
+                matches = self._evaluate(xpath, elements)
+            if marked is not None:
+                matches = [e for e in matches if e in marked]
+            results.extend(matches)
+        if len(plan) > 1:
+            results = document_order(results)
+        return results
+
+    def _index_select(self, selector, elements, axis):
+        if self._index is None:
+            return None
+        lower_case = getattr(self._translator, 'lower_case_element_names',
+                             False)
+        return self._index.select(selector, elements, axis, lower_case)
+
+    def _matcher(self, selector):
+        """Return a function telling if an element matches selector without
+        using XPath, or None if the selector is too complex"""
+        translator = self._translator
+        if not isinstance(selector, str) or not isinstance(
+                translator, JQueryTranslator):
+            return None
+        return compile_matcher(
+            selector, getattr(translator, 'lower_case_element_names', False))
+
+    def _chains(self, selector):
+        """Return the chains of selector for :class:`ChainMatcher`, or None
+        if it can't be matched while walking the tree"""
+        translator = self._translator
+        if not isinstance(translator, JQueryTranslator):
+            return None
+        return compile_chains(
+            selector, getattr(translator, 'lower_case_element_names', False))
+
+    def _roots(self, axis='descendant-or-self::'):
+        """Return the disjoint subtrees holding the elements along axis
+        (``descendant-or-self::`` or ``descendant::``) from the elements,
+        in document order"""
+        contexts = [e for e in self if isinstance(e, etree._Element) and
+                    isinstance(e.tag, str)]
+        nodes = set(contexts)
+        # skip the contexts in the subtree of another one
+        roots = [e for e in document_order(contexts)
+                 if not any(a in nodes for a in e.iterancestors())]
+        if axis == 'descendant::':
+            roots = [child for e in roots for child in e
+                     if isinstance(child.tag, str)]
+        return roots
+
+    def _iter_select(self, selector, axis='descendant-or-self::'):
+        """Yield the elements matching selector along axis from the
+        elements, in document order. Selectors supported by
+        :meth:`select_many` are matched as the tree is walked, so that the
+        walk stops with the iteration"""
+        chains = self._chains(selector)
+        if chains is None or self._index is not None:
+            if self:
+                yield from self._select(selector, self, axis)
+            return
+        matcher = ChainMatcher({selector: chains})
+        for _, element in matcher.iter(self._roots(axis)):
+            yield element
+
+    def _attach_index(self, elements, indexed):
+        """Use the index of the document of elements, creating it if
+        indexed is true. The index of the parent is kept for elements of
+        the same document only"""
+        if (indexed or self._index is None or
+                self._index.document is not document_root(elements)):
+            self._index = document_index(elements, create=indexed)
+
+    def _invalidate_index(self):
+        if self._index is not None:
+            self._index.invalidate()
+        invalidate_indexes(self)
 
     def _copy(self, *args, **kwargs):
         kwargs.setdefault('namespaces', self.namespaces)
@@ -304,13 +772,78 @@ class PyQuery(list):
             >>> list(d.items('a')) == list(d('a').items())
             True
         """
-        if selector:
-            elems = self(selector) or []
-        else:
+        if not selector:
             elems = self
+        elif isinstance(selector, str) and not selector.startswith('<'):
+            elems = self._iter_select(selector)
+        else:
+            elems = self(selector) or []
         for elem in elems:
             yield self._copy(elem, parent=self)
 
+    @classmethod
+    def iterparse(cls, source, selector, parser='xml', namespaces=None):
+        """Parse source incrementally and yield a PyQuery object for each
+        element matching selector. source can be a path, a file object or an
+        iterable of bytes:
+
+            >>> feed = [b'<feed><item id="1"><b>a</b></item>',
+            ...         b'<item id="2"/></feed>']
+            >>> [i.attr('id') for i in PyQuery.iterparse(feed, 'item')]
+            ['1', '2']
+
+        Matched elements are cleared, and their previous siblings and those
+        of their ancestors removed, once the next element is requested. So
+        memory use depends on the size of a record, not of the document.
+        This also means that selectors should not rely on previous siblings
+        or match elements nested in other matches.
+        """
+        if parser == 'xml':
+            pull_parser = etree.XMLPullParser(events=('end',))
+        elif parser == 'html':
+            pull_parser = etree.HTMLPullParser(events=('end',))
+        else:
+            raise ValueError(f'No such parser: "{parser}"')
+        query = cls([], parser=parser, namespaces=namespaces)
+        groups = [group.parsed_tree for group in parse_selector(selector)]
+        if any(isinstance(tree, CombinedSelector) for tree in groups):
+            # the rightmost compound selectors are tested first. The
+            # ancestors are only checked, from the (partial) root, for the
+            # elements matching them
+            rightmost = ', '.join(
+                (tree.subselector if isinstance(tree, CombinedSelector)
+                 else tree).canonical() for tree in groups)
+            candidate = query._xpath(query._css_to_xpath(rightmost, 'self::'))
+            xpath = query._xpath(query._css_to_xpath(selector))
+
+            def matches(element):
+                if not candidate(element):
+                    return False
+                root = element.getroottree().getroot()
+                return element in xpath(root)
+        else:
+            matches = query._xpath(query._css_to_xpath(selector, 'self::'))
+
+        def read_events():
+            for _, element in pull_parser.read_events():
+                if not isinstance(element.tag, str) or not matches(element):
+                    continue
+                yield cls(element, parser=parser, namespaces=namespaces)
+                element.clear(keep_tail=True)
+                for node in itertools.chain([element],
+                                            element.iterancestors()):
+                    parent = node.getparent()
+                    if parent is None:
+                        break
+                    while node.getprevious() is not None:
+                        del parent[0]
+
+        for chunk in iter_chunks(source):
+            pull_parser.feed(chunk)
+            yield from read_events()
+        pull_parser.close()
+        yield from read_events()
+
     def xhtml_to_html(self):
         """Remove xhtml namespace:
 
@@ -327,6 +860,7 @@ class PyQuery(list):
             pass
         else:
             lxml.html.xhtml_to_html(root)
+            self._invalidate_index()
         return self
 
     def remove_namespaces(self):
@@ -346,6 +880,7 @@ class PyQuery(list):
             for el in root.iter('{*}*'):
                 if el.tag.startswith('{'):
                     el.tag = el.tag.split('}', 1)[1]
+            self._invalidate_index()
         return self
 
     def _serialize_nodes(self, dumps, method):
@@ -416,62 +951,94 @@ class PyQuery(list):
     # Traversing #
     ##############
 
-    def _filter_only(self, selector, elements, reverse=False, unique=False):
+    def _filter_only(self, selector, elements):
         """Filters the selection set only, as opposed to also including
            descendants.
         """
         if selector is None:
             results = elements
         else:
-            xpath = self._css_to_xpath(selector, 'self::')
-            results = []
-            for tag in elements:
-                results.extend(tag.xpath(xpath, namespaces=self.namespaces))
-        if reverse:
-            results.reverse()
-        if unique:
-            result_list = results
-            results = []
-            for item in result_list:
-                if item not in results:
-                    results.append(item)
+            results = self._index_select(selector, elements, 'self::')
+            if results is None:
+                match = self._matcher(selector)
+                if match is not None:
+                    results = [e for e in elements
+                               if isinstance(e, etree._Element) and match(e)]
+            if results is None:
+                results = self._positional_select(
+                    selector, elements, 'self::')
+            if results is None:
+                results = self._has_select(selector, elements, 'self::')
+            if results is None:
+                xpath = self._xpath(self._css_to_xpath(selector, 'self::'))
+                results = []
+                for tag in elements:
+                    if isinstance(tag.tag, str):
+                        results.extend(xpath(tag))
         return self._copy(results, parent=self)
 
+    def _traverse(self, method):
+        """Yield the nodes reached by calling method repeatedly from each
+        element. Walks stop at nodes already reached from another element,
+        so each node is visited once"""
+        seen = set()
+        for e in self:
+            current = getattr(e, method)()
+            while current is not None and current not in seen:
+                seen.add(current)
+                yield current
+                current = getattr(current, method)()
+
+    def _iter_traverse(self, method, selector):
+        """Yield the nodes reached by :meth:`_traverse` matching selector,
+        as they are reached. Nodes are matched one by one with the lxml API
+        or a ``self::`` XPath expression, except for positional selectors
+        and selectors with combinators which are evaluated on all the nodes
+        at once, like :meth:`filter`. The nodes are yielded in the order of
+        the traversal in all cases. Elements matched by :meth:`filter` with
+        combinators which are not traversed nodes come last"""
+        nodes = self._traverse(method)
+        if selector is None:
+            yield from nodes
+            return
+        match = self._matcher(selector)
+        if match is None and (
+                compile_positional_plan(selector) is not None or
+                any(isinstance(group.parsed_tree, CombinedSelector)
+                    for group in parse_selector(selector))):
+            nodes = list(nodes)
+            results = self._filter_only(selector, document_order(nodes))
+            matched = set(results)
+            yield from (node for node in nodes if node in matched)
+            traversed = set(nodes)
+            yield from (e for e in results if e not in traversed)
+            return
+        if match is None:
+            xpath = self._xpath(self._css_to_xpath(selector, 'self::'))
+
+            def match(node):
+                return bool(xpath(node))
+        for node in nodes:
+            if isinstance(node.tag, str) and match(node):
+                yield node
+
     def parent(self, selector=None):
         return self._filter_only(
             selector,
-            [e.getparent() for e in self if e.getparent() is not None],
-            unique=True)
+            document_order(e.getparent() for e in self
+                           if e.getparent() is not None))
 
     def prev(self, selector=None):
         return self._filter_only(
             selector,
-            [e.getprevious() for e in self if e.getprevious() is not None])
+            document_order(e.getprevious() for e in self
+                           if e.getprevious() is not None))
 
     def next(self, selector=None):
         return self._filter_only(
             selector,
-            [e.getnext() for e in self if e.getnext() is not None])
-
-    def _traverse(self, method):
-        for e in self:
-            current = getattr(e, method)()
-            while current is not None:
-                yield current
-                current = getattr(current, method)()
-
-    def _traverse_parent_topdown(self):
-        for e in self:
-            this_list = []
-            current = e.getparent()
-            while current is not None:
-                this_list.append(current)
-                current = current.getparent()
-            this_list.reverse()
-            yield from this_list
-
-    def _next_all(self):
-        return [e for e in self._traverse('getnext')]
+            document_order(e.getnext() for e in self
+                           if e.getnext() is not None))
 
     @with_camel_case_alias
     def next_all(self, selector=None):
@@ -483,7 +1050,8 @@ class PyQuery(list):
         >>> d('p:last').nextAll()
         [<img>]
         """
-        return self._filter_only(selector, self._next_all())
+        return self._filter_only(
+            selector, document_order(self._traverse('getnext')))
 
     @with_camel_case_alias
     def next_until(self, selector, filter_=None):
@@ -497,17 +1065,20 @@ class PyQuery(list):
         >>> d('h2:first').nextUntil('h2')
         [<p>, <p>]
         """
-        return self._filter_only(
-            filter_, [
-                e
-                for q in itertools.takewhile(
-                    lambda q: not q.is_(selector), self.next_all().items())
-                for e in q
-            ]
-        )
-
-    def _prev_all(self):
-        return [e for e in self._traverse('getprevious')]
+        # match the selector once for all the following siblings
+        following = self._copy(
+            document_order(self._traverse('getnext')), parent=self)
+        stop = set(following.filter(selector))
+        results = []
+        seen = set()
+        for e in self:
+            current = e.getnext()
+            while (current is not None and current not in stop and
+                   current not in seen):
+                seen.add(current)
+                results.append(current)
+                current = current.getnext()
+        return self._filter_only(filter_, document_order(results))
 
     @with_camel_case_alias
     def prev_all(self, selector=None):
@@ -519,7 +1090,8 @@ class PyQuery(list):
         >>> d('p:last').prevAll()
         [<p.hello>]
         """
-        return self._filter_only(selector, self._prev_all(), reverse=True)
+        return self._filter_only(
+            selector, document_order(self._traverse('getprevious')))
 
     def siblings(self, selector=None):
         """
@@ -531,7 +1103,18 @@ class PyQuery(list):
          [<img>]
 
         """
-        return self._filter_only(selector, self._prev_all() + self._next_all())
+        # an element is a sibling of the selection unless it is the only
+        # selected child of its parent
+        selected = {}
+        for e in self:
+            parent = e.getparent()
+            if parent is not None:
+                selected.setdefault(parent, set()).add(e)
+        results = [child
+                   for parent, children in selected.items()
+                   for child in parent
+                   if len(children) > 1 or child not in children]
+        return self._filter_only(selector, document_order(results))
 
     def parents(self, selector=None):
         """
@@ -544,10 +1127,42 @@ class PyQuery(list):
         []
         """
         return self._filter_only(
-            selector,
-            [e for e in self._traverse_parent_topdown()],
-            unique=True
-        )
+            selector, document_order(self._traverse('getparent')))
+
+    def iter_parents(self, selector=None):
+        """Yield the ancestors of the elements matching selector while they
+        are walked, closest first. Unlike :meth:`parents` no list is built,
+        so it is cheap to stop early::
+
+            >>> d = PyQuery('<div><ul><li><b>x</b></li></ul></div>')
+            >>> list(d('b').iter_parents())
+            [<Element li at ...>, <Element ul at ...>, <Element div at ...>]
+            >>> next(d('b').iter_parents('ul'))
+            <Element ul at ...>
+
+        Ancestors shared by several elements are yielded once.
+        """
+        return self._iter_traverse('getparent', selector)
+
+    def iter_next_all(self, selector=None):
+        """Yield the following siblings of the elements matching selector
+        while they are walked, closest first::
+
+            >>> d = PyQuery('<p><a/><b/><i/><b/></p>')
+            >>> list(d('a').iter_next_all('b'))
+            [<Element b at ...>, <Element b at ...>]
+        """
+        return self._iter_traverse('getnext', selector)
+
+    def iter_prev_all(self, selector=None):
+        """Yield the preceding siblings of the elements matching selector
+        while they are walked, closest first::
+
+            >>> d = PyQuery('<p><a/><b/><i/><b/></p>')
+            >>> list(d('i').iter_prev_all())
+            [<Element b at ...>, <Element a at ...>]
+        """
+        return self._iter_traverse('getprevious', selector)
 
     def children(self, selector=None):
         """Filter elements that are direct children of self using optional
@@ -561,7 +1176,9 @@ class PyQuery(list):
             >>> d.children('.hello')
             [<p.hello>]
         """
-        elements = [child for tag in self for child in tag.getchildren()]
+        elements = [child for tag in self for child in tag]
+        if len(self) > 1:
+            elements = document_order(elements)
         return self._filter_only(selector, elements)
 
     def closest(self, selector=None):
@@ -576,14 +1193,61 @@ class PyQuery(list):
         >>> d('strong').closest('form')
         []
         """
+        if selector is None:
+            def match(element):
+                return True
+        else:
+            match = self._matcher(selector)
+        if match is None:
+            def match(element):
+                return bool(self._filter_only(selector, [element]))
+        # closest match of each visited node, shared by elements with
+        # common ancestors
+        closest = {}
         result = []
-        for current in self:
-            while (current is not None and
-                    not self._copy(current).is_(selector)):
+        for element in self:
+            path = []
+            current = element
+            while current is not None and current not in closest:
+                if match(current):
+                    closest[current] = current
+                    break
+                path.append(current)
                 current = current.getparent()
-            if current is not None:
-                result.append(current)
-        return self._copy(result, parent=self)
+            found = closest.get(current)
+            for node in path:
+                closest[node] = found
+            if found is not None:
+                result.append(found)
+        return self._copy(document_order(result), parent=self)
+
+    def search(self, text):
+        """Return the innermost elements containing text, in self or their
+        descendants:
+
+            >>> d = PyQuery('<div><p>Price: <b>10</b></p><p>No price</p></div>')
+            >>> d.search('Price')
+            [<p>]
+            >>> d.search('10')
+            [<b>]
+            >>> d.search('Price: 10')
+            [<p>]
+
+        The text of the document is indexed the first time it is searched
+        when the document is indexed (see ``indexed``). Otherwise it is
+        indexed for this call only.
+        """
+        elements = [e for e in self if isinstance(e.tag, str)]
+        results = None
+        if self._index is not None and elements:
+            results = self._index.search(text, elements)
+        if results is None:
+            roots = {}
+            for e in elements:
+                roots.setdefault(e.getroottree().getroot(), []).append(e)
+            results = [e for root, group in roots.items()
+                       for e in DocumentIndex(root).search(text, group)]
+        return self._copy(results, parent=self)
 
     def contents(self):
         """
@@ -593,10 +1257,15 @@ class PyQuery(list):
             >>> d.contents()  # doctest: +ELLIPSIS
             ['hello ', <Element b at ...>]
         """
+        xpath = self._xpath('child::text()|child::*')
         results = []
         for elem in self:
-            results.extend(elem.xpath('child::text()|child::*',
-                           namespaces=self.namespaces))
+            if isinstance(elem.tag, str):
+                results.extend(xpath(elem))
+            else:
+                # compiled expressions only accept elements
+                results.extend(elem.xpath('child::text()|child::*',
+                                          namespaces=self.namespaces))
         return self._copy(results, parent=self)
 
     def filter(self, selector):
@@ -638,7 +1307,15 @@ class PyQuery(list):
             >>> d('p').not_('.hello')
             [<p>]
         """
-        exclude = set(self._copy(selector, self))
+        match = self._matcher(selector)
+        if match is not None:
+            return self._copy(
+                [e for e in self
+                 if not (isinstance(e, etree._Element) and match(e))],
+                parent=self)
+        # the same set level evaluation as filter(), so that positional
+        # selectors like :even apply to the elements
+        exclude = set(self._filter_only(selector, self))
         return self._copy([e for e in self if e not in exclude],
                           parent=self)
 
@@ -658,9 +1335,13 @@ class PyQuery(list):
 
         ..
         """
+        match = self._matcher(selector)
+        if match is not None:
+            return any(isinstance(e, etree._Element) and match(e)
+                       for e in self)
         return bool(self._filter_only(selector, self))
 
-    def find(self, selector):
+    def find(self, selector, limit=None, offset=0):
         """Find elements using selector traversing down from self:
 
             >>> m = '<p><span><em>Whoah!</em></span></p><p><em> there</em></p>'
@@ -669,17 +1350,119 @@ class PyQuery(list):
             [<em>, <em>]
             >>> d('p').eq(1).find('em')
             [<em>]
+
+        Use limit and offset to get a slice of the result. The search stops
+        once limit elements are found if possible::
+
+            >>> d('p').find('em', limit=1, offset=1)
+            [<em>]
         """
-        xpath = self._css_to_xpath(selector)
-        results = [child.xpath(xpath, namespaces=self.namespaces)
-                   for tag in self
-                   for child in tag.getchildren()]
-        # Flatten the results
-        elements = []
-        for r in results:
-            elements.extend(r)
+        if not self:
+            return self._copy([], parent=self)
+        if limit is None and not offset:
+            elements = self._select(selector, self, 'descendant::')
+        else:
+            stop = None if limit is None else offset + limit
+            elements = list(itertools.islice(
+                self._iter_select(selector, 'descendant::'), offset, stop))
         return self._copy(elements, parent=self)
 
+    def iter_find(self, selector):
+        """Yield the elements of :meth:`find` as the tree is walked::
+
+            >>> d = PyQuery('<div><p>1</p><p>2</p></div>')
+            >>> [e.text for e in d.iter_find('p')]
+            ['1', '2']
+
+        Selectors made of tag, id, class, attribute and ``:contains()``
+        parts joined by descendant or child combinators are matched lazily,
+        so the walk stops when the iteration does. Other selectors are
+        evaluated at once.
+        """
+        return self._iter_select(selector, 'descendant::')
+
+    def first(self, selector):
+        """Return the first element matching selector, like
+        ``self(selector).eq(0)`` but without looking for the other ones::
+
+            >>> d = PyQuery('<div><p>1</p><p>2</p></div>')
+            >>> d.first('p')
+            [<p>]
+            >>> d.first('span')
+            []
+        """
+        for element in self._iter_select(selector):
+            return self._copy([element], parent=self)
+        return self._copy([], parent=self)
+
+    def exists(self, selector):
+        """Tell if selector matches an element, like
+        ``bool(self(selector))``::
+
+            >>> d = PyQuery('<div><p>1</p><p>2</p></div>')
+            >>> d.exists('div p'), d.exists('div span')
+            (True, False)
+        """
+        for element in self._iter_select(selector):
+            return True
+        return False
+
+    def count(self, selector):
+        """Return the number of elements matching selector, like
+        ``len(self(selector))``::
+
+            >>> d = PyQuery('<div><p>1</p><p>2</p></div>')
+            >>> d.count('p')
+            2
+
+        Elements are counted by XPath's ``count()`` when possible. When
+        the value is not a string or the list holds other values than
+        elements, like the results of :meth:`map`, values are counted like
+        ``list.count()``::
+
+            >>> d('p').map(lambda i, e: PyQuery(e).text()).count('2')
+            1
+
+        """
+        if not isinstance(selector, str) or not self._only_elements():
+            return list.count(self, selector)
+        if not self:
+            return 0
+        if (self._index is None and
+                compile_positional_plan(selector) is None and
+                self._has_plan(selector, 'descendant-or-self::') is None):
+            xpath = self._xpath(f'count({self._css_to_xpath(selector)})')
+            return sum(int(xpath(root)) for root in self._roots())
+        return len(self._select(selector, self))
+
+    def select_many(self, selectors):
+        """Return a dict mapping the names of a dict of selectors to their
+        matches, like ``self(selector)`` for each selector::
+
+            >>> d = PyQuery('<div><p class="a"><b>1</b></p><p>2</p></div>')
+            >>> d.select_many({'p': 'p', 'a': '.a', 'b': 'div > p b'})
+            {'p': [<p.a>, <p>], 'a': [<p.a>], 'b': [<b>]}
+
+        Selectors made of tag, id, class, attribute and ``:contains()``
+        parts joined by descendant or child combinators are all matched
+        during one walk of the tree. Other selectors are evaluated
+        separately.
+        """
+        results = {}
+        chains = {}
+        for selector in set(selectors.values()):
+            compiled = self._chains(selector)
+            if compiled is not None:
+                chains[selector] = compiled
+            elif self:
+                results[selector] = self._select(selector, self)
+            else:
+                results[selector] = []
+        if chains:
+            results.update(ChainMatcher(chains).match(self._roots()))
+        return {name: self._copy(results[selector], parent=self)
+                for name, selector in selectors.items()}
+
     def eq(self, index):
         """Return PyQuery of only the element with the provided index::
 
@@ -701,6 +1484,65 @@ class PyQuery(list):
             items = []
         return self._copy(items, parent=self)
 
+    def _only_elements(self):
+        """Tell if the list only holds elements"""
+        return all(isinstance(e, etree._Element) for e in self)
+
+    def index(self, selector=None, *args):
+        """Return the position of the first element among its sibling
+        elements, or the position of an element in the selection::
+
+            >>> d = PyQuery('<ul><li>a</li><!-- b --><li class="c">c</li></ul>')
+            >>> d('.c').index()
+            1
+            >>> d('li').index(d('.c'))
+            1
+            >>> d('.c').index('li')
+            1
+            >>> d('li').index(d('ul'))
+            -1
+
+        When a selector is given, return the position of the first element
+        in the elements of the document matching the selector.
+
+        Positions among siblings are cached when the document is indexed
+        (see ``indexed``), so that they are found in constant time.
+        Otherwise the preceding siblings are counted.
+
+        With ``start`` and ``stop`` arguments, or when the list holds other
+        values than elements, like the results of :meth:`map`, this is
+        ``list.index()``::
+
+            >>> d('li').map(lambda i, e: PyQuery(e).text()).index('c')
+            1
+
+        """
+        if args or not self._only_elements():
+            return list.index(self, selector, *args)
+        if selector is None:
+            if not self:
+                return -1
+            element = self[0]
+            if self._index is not None and isinstance(element.tag, str):
+                return self._index.sibling_position(element)[0]
+            return sum(1 for e in element.itersiblings(preceding=True)
+                       if isinstance(e.tag, str))
+        if isinstance(selector, basestring):
+            if not self:
+                return -1
+            root = self[0].getroottree().getroot()
+            elements, element = self._copy(selector, root), self[0]
+        elif isinstance(selector, PyQuery):
+            if not selector:
+                return -1
+            elements, element = self, selector[0]
+        else:
+            elements, element = self, selector
+        for i, e in enumerate(elements):
+            if e is element:
+                return i
+        return -1
+
     def each(self, func):
         """apply func on each nodes
         """
@@ -755,6 +1597,17 @@ class PyQuery(list):
     def size(self):
         return len(self)
 
+    def lazy(self):
+        """Return a :class:`~pyquery.lazy.LazyQuery` recording the following
+        traversal methods and evaluating them when the result is needed:
+
+            >>> d = PyQuery('<div><p><a class="ext">1</a><a>2</a></p></div>')
+            >>> d.lazy()('p').find('a').filter('.ext').text()
+            '1'
+        """
+        from .lazy import LazyQuery
+        return LazyQuery(self, self, self._parent, xpath='self::node()')
+
     def end(self):
         """Break out of a level of traversal and return to the parent level.
 
@@ -803,8 +1656,46 @@ class PyQuery(list):
         else:
             for tag in self:
                 tag.set(attr, value)
+        self._invalidate_index()
         return self
 
+    def attrs(self, *names, skip_missing=False, default=None):
+        """Return the value of an attribute for each element::
+
+            >>> d = PyQuery('<p><a href="/a">A</a><a>B</a></p>')
+            >>> d('a').attrs('href')
+            ['/a', None]
+            >>> d('a').attrs('href', skip_missing=True)
+            ['/a']
+
+        With several names, return a tuple of values for each element::
+
+            >>> d('a').attrs('href', 'title', default='')
+            [('/a', ''), ('', '')]
+
+        ``skip_missing`` skips the elements without all the attributes.
+        Missing values are ``default`` otherwise.
+        """
+        if not names:
+            raise ValueError('You must provide at least an attribute name')
+        mapping = {'class_': 'class', 'for_': 'for'}
+        names = [mapping.get(name, name) for name in names]
+        missing = no_default if skip_missing else default
+        # skip text, comments and processing instructions
+        elements = [e for e in self if isinstance(e, etree._Element) and
+                    isinstance(e.tag, str)]
+        if len(names) == 1:
+            name = names[0]
+            values = [e.get(name, missing) for e in elements]
+            if skip_missing:
+                values = [v for v in values if v is not no_default]
+            return values
+        values = [tuple([e.get(name, missing) for name in names])
+                  for e in elements]
+        if skip_missing:
+            values = [v for v in values if no_default not in v]
+        return values
+
     @with_camel_case_alias
     def remove_attr(self, name):
         """Remove an attribute::
@@ -822,6 +1713,7 @@ class PyQuery(list):
                 del tag.attrib[name]
             except KeyError:
                 pass
+        self._invalidate_index()
         return self
 
     attr = FlexibleElement(pget=attr, pdel=remove_attr)
@@ -870,6 +1762,7 @@ class PyQuery(list):
             classes = (tag.get('class') or '').split()
             classes += [v for v in values if v not in classes]
             tag.set('class', ' '.join(classes))
+        self._invalidate_index()
         return self
 
     @with_camel_case_alias
@@ -892,6 +1785,7 @@ class PyQuery(list):
             classes = ' '.join(classes)
             if classes.strip() or tag.get('class'):
                 tag.set('class', classes)
+        self._invalidate_index()
         return self
 
     @with_camel_case_alias
@@ -913,6 +1807,7 @@ class PyQuery(list):
             classes = [v for v in classes if v not in values_to_del]
             classes += values_to_add
             tag.set('class', ' '.join(classes))
+        self._invalidate_index()
         return self
 
     def css(self, *args, **kwargs):
@@ -952,6 +1847,7 @@ class PyQuery(list):
                         el.split(':')[0].strip() != attr.strip())]
                 current.append(f'{attr}: {value}')
                 tag.set('style', '; '.join(current))
+        self._invalidate_index()
         return self
 
     css = FlexibleElement(pget=css, pset=css)
@@ -1134,16 +2030,17 @@ class PyQuery(list):
             else:
                 raise ValueError(type(value))
 
-            for tag in self:
+            root = fragment_fromstring(new_html, self.parser)
+            children = root.getchildren()
+            for i, tag in enumerate(self):
                 for child in tag.getchildren():
                     tag.remove(child)
-                root = fromstring(
-                    '<root>' + new_html + '</root>',
-                    self.parser)[0]
-                children = root.getchildren()
+                if i > 0:
+                    children = deepcopy(children)
                 if children:
                     tag.extend(children)
                 tag.text = root.text
+            self._invalidate_index()
         return self
 
     @with_camel_case_alias
@@ -1194,6 +2091,14 @@ class PyQuery(list):
             toto
             tata
 
+        Get the beginning of the text. The walk of the tree stops when
+        ``max_chars`` characters or ``max_bytes`` bytes of UTF-8 are found::
+
+            >>> doc = PyQuery('<div><p>toto</p><p>tata</p></div>')
+            >>> print(doc.text(max_chars=6))
+            toto
+            t
+
         Set the text value::
 
             >>> doc.text('Youhou !')
@@ -1206,28 +2111,70 @@ class PyQuery(list):
         if value is no_default:
             if not self:
                 return ''
-            return ' '.join(
-                self._copy(tag).html(escape=False) if tag.tag == 'textarea' else
-                extract_text(tag, **kwargs) for tag in self
-            )
+            max_chars = kwargs.pop('max_chars', None)
+            max_bytes = kwargs.pop('max_bytes', None)
+            if max_chars is None and max_bytes is None:
+                return ' '.join(self.texts(**kwargs))
+            return join_chunks(self._iter_text(**kwargs), max_chars,
+                               max_bytes)
 
         for tag in self:
             for child in tag.getchildren():
                 tag.remove(child)
             tag.text = value
+        self._invalidate_index()
         return self
 
+    def _iter_text(self, **kwargs):
+        """Yield the chunks of :meth:`text` as the tree is walked"""
+        for i, tag in enumerate(self):
+            if i:
+                yield ' '
+            if tag.tag == 'textarea':
+                yield self._copy(tag).html(escape=False)
+            else:
+                yield from iter_text(tag, **kwargs)
+
+    def texts(self, **kwargs):
+        """Return the text of each element, as :meth:`text` would return
+        it for each of them::
+
+            >>> d = PyQuery('<div><p>toto</p><p>ta<b>ta</b></p></div>')
+            >>> d('div, p').texts()
+            ['toto\\ntata', 'toto', 'tata']
+
+        The subtrees of block elements nested in other elements are walked
+        once. Their texts are cached until the document is modified when
+        the document is indexed (see ``indexed``).
+        """
+        memo = None
+        elements = [tag for tag in self if tag.tag != 'textarea']
+        # texts of other documents would not be invalidated
+        if self._index is not None and all(
+                self._index.holds(tag) for tag in elements):
+            memo = self._index.text_summaries.setdefault(
+                tuple(sorted(kwargs.items())), {})
+        texts = iter(extract_texts(elements, memo=memo, **kwargs))
+        return [self._copy(tag).html(escape=False) if tag.tag == 'textarea'
+                else next(texts) for tag in self]
+
     ################
     # Manipulating #
     ################
 
     def _get_root(self, value):
+        self._invalidate_index()
         if isinstance(value, basestring):
-            root = fromstring('<root>' + value + '</root>',
-                              self.parser)[0]
+            fragment = fragment_fromstring(value, self.parser)
+            # the list of nodes, copied for each target
+            return fragment[:], fragment.text or ''
         elif isinstance(value, etree._Element):
+            # the node is moved out of its document
+            invalidate_indexes([value])
             root = self._copy(value)
         elif isinstance(value, PyQuery):
+            # nodes are moved out of value's document
+            value._invalidate_index()
             root = value
         else:
             raise TypeError(
@@ -1243,6 +2190,8 @@ class PyQuery(list):
         """
         root, root_text = self._get_root(value)
         for i, tag in enumerate(self):
+            if i > 0:
+                root = deepcopy(list(root))
             if len(tag) > 0:  # if the tag has children
                 last_child = tag[-1]
                 if not last_child.tail:
@@ -1252,8 +2201,6 @@ class PyQuery(list):
                 if not tag.text:
                     tag.text = ''
                 tag.text += root_text
-            if i > 0:
-                root = deepcopy(list(root))
             tag.extend(root)
         return self
 
@@ -1269,6 +2216,8 @@ class PyQuery(list):
         """
         root, root_text = self._get_root(value)
         for i, tag in enumerate(self):
+            if i > 0:
+                root = deepcopy(list(root))
             if not tag.text:
                 tag.text = ''
             if len(root) > 0:
@@ -1276,10 +2225,7 @@ class PyQuery(list):
                 tag.text = root_text
             else:
                 tag.text = root_text + tag.text
-            if i > 0:
-                root = deepcopy(list(root))
             tag[:0] = root
-            root = tag[:len(root)]
         return self
 
     @with_camel_case_alias
@@ -1294,15 +2240,14 @@ class PyQuery(list):
         """
         root, root_text = self._get_root(value)
         for i, tag in enumerate(self):
+            if i > 0:
+                root = deepcopy(list(root))
             if not tag.tail:
                 tag.tail = ''
             tag.tail += root_text
-            if i > 0:
-                root = deepcopy(list(root))
             parent = tag.getparent()
             index = parent.index(tag) + 1
             parent[index:index] = root
-            root = parent[index:len(root)]
         return self
 
     @with_camel_case_alias
@@ -1317,6 +2262,8 @@ class PyQuery(list):
         """
         root, root_text = self._get_root(value)
         for i, tag in enumerate(self):
+            if i > 0:
+                root = deepcopy(list(root))
             previous = tag.getprevious()
             if previous is not None:
                 if not previous.tail:
@@ -1327,12 +2274,9 @@ class PyQuery(list):
                 if not parent.text:
                     parent.text = ''
                 parent.text += root_text
-            if i > 0:
-                root = deepcopy(list(root))
             parent = tag.getparent()
             index = parent.index(tag)
             parent[index:index] = root
-            root = parent[index:len(root)]
         return self
 
     @with_camel_case_alias
@@ -1374,6 +2318,7 @@ class PyQuery(list):
                         t.addnext(wrapper)
                         parent.remove(t)
                         break
+        self._invalidate_index()
         self[:] = nodes
         return self
 
@@ -1423,6 +2368,7 @@ class PyQuery(list):
                     parent.remove(tag)
                 parent.append(wrapper)
 
+        self._invalidate_index()
         self[:] = [wrapper]
         return self
 
@@ -1452,6 +2398,7 @@ class PyQuery(list):
                 self._copy(tag).before(value + (tag.tail or ''))
                 parent = tag.getparent()
                 parent.remove(tag)
+        self._invalidate_index()
         return self
 
     @with_camel_case_alias
@@ -1475,6 +2422,7 @@ class PyQuery(list):
         for tag in self:
             tag.text = None
             tag[:] = []
+        self._invalidate_index()
         return self
 
     def remove(self, expr=no_default):
@@ -1504,6 +2452,7 @@ class PyQuery(list):
                                 prev.tail = ''
                             prev.tail += tag.tail
                     parent.remove(tag)
+            self._invalidate_index()
         else:
             results = self._copy(expr, self)
             results.remove()
@@ -1660,6 +2609,85 @@ class PyQuery(list):
         if self._parent is not no_default:
             return self._parent.base_url
 
+    @classmethod
+    def _loader(cls, url, timeout, kwargs):
+        """Return a function loading url, giving timeout to the default
+        opener so that the blocking call ends with the operation"""
+        if 'opener' not in kwargs:
+            kwargs = dict(kwargs, timeout=timeout)
+        return functools.partial(cls, url=url, **kwargs)
+
+    @classmethod
+    async def afetch(cls, url, timeout=DEFAULT_TIMEOUT, executor=None,
+                     **kwargs):
+        """Load and parse url in an executor without blocking the event loop.
+        Extra keyword arguments are the ones accepted by ``PyQuery(url=...)``.
+        asyncio.TimeoutError is raised if the whole operation takes more than
+        timeout seconds. The timeout is given to the default opener so that
+        the request stops too. Custom openers must stop by themselves.
+        """
+        loop = asyncio.get_running_loop()
+        load = cls._loader(url, timeout, kwargs)
+        return await asyncio.wait_for(
+            loop.run_in_executor(executor, load), timeout)
+
+    @classmethod
+    async def fetch_many(cls, urls, concurrency=10, timeout=DEFAULT_TIMEOUT,
+                         **kwargs):
+        """Asynchronous generator loading at most concurrency urls at a
+        time. Yield ``(url, result)`` tuples in completion order, where
+        result is a PyQuery object or the exception raised for this url.
+
+        A url timing out is yielded at once, but its thread is only reused
+        once the opener returns. The timeout of each url starts when its
+        thread starts, not while it waits for a thread.
+        """
+        urls = iter(urls)
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        # free threads. Released when the opener returns, which may be after
+        # the timeout
+        threads = asyncio.Semaphore(concurrency)
+        jobs = set()
+
+        def release(job):
+            jobs.discard(job)
+            if not job.cancelled():
+                # retrieve the error of timed out jobs
+                job.exception()
+            threads.release()
+
+        async def fetch(url):
+            await threads.acquire()
+            job = loop.run_in_executor(
+                executor, cls._loader(url, timeout, kwargs))
+            jobs.add(job)
+            job.add_done_callback(release)
+            try:
+                return url, await asyncio.wait_for(
+                    asyncio.shield(job), timeout)
+            except Exception as e:  # NOQA
+                return url, e
+
+        pending = set()
+        try:
+            for url in itertools.islice(urls, concurrency):
+                pending.add(asyncio.ensure_future(fetch(url)))
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for url in itertools.islice(urls, len(done)):
+                    pending.add(asyncio.ensure_future(fetch(url)))
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            # stop waiting for the threads still running
+            for job in list(jobs):
+                job.cancel()
+            executor.shutdown(wait=False)
+
     def make_links_absolute(self, base_url=None):
         """Make all links absolute.
         """
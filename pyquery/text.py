@@ -1,5 +1,7 @@
 import re
 
+from lxml import etree
+
 # https://developer.mozilla.org/en-US/docs/Web/HTML/Inline_elements#Elements
 INLINE_TAGS = {
     'a', 'abbr', 'acronym', 'b', 'bdo', 'big', 'br', 'button', 'cite',
@@ -23,88 +25,446 @@ def squash_html_whitespace(text):
     return WHITESPACE_RE.sub(' ', text)
 
 
-def _squash_artifical_nl(parts):
-    output, last_nl = [], False
-    for x in parts:
-        if x is not None:
-            output.append(x)
-            last_nl = False
-        elif not last_nl:
-            output.append(None)
-            last_nl = True
-    return output
-
-
-def _strip_artifical_nl(parts):
-    if not parts:
-        return parts
-    for start_idx, pt in enumerate(parts):
-        if isinstance(pt, str):
-            # 0, 1, 2, index of first string [start_idx:...
+# marks a missing token
+NOTHING = object()
+
+
+def iter_text(dom, block_symbol='\n', sep_symbol='\n', squash_space=True):
+    """Yield the chunks of :func:`extract_text` as the tree is walked, for
+    example to write them to a file with ``writelines()``::
+
+        >>> from lxml import etree
+        >>> dom = etree.fromstring('<div><p>a   b</p><p>c</p></div>')
+        >>> list(iter_text(dom))
+        ['a b', '\\n', 'c']
+
+    """
+    if callable(dom.tag):
+        return
+    if squash_space:
+        yield from _iter_squashed_text(dom, block_symbol, sep_symbol)
+    else:
+        yield from _iter_raw_text(dom, block_symbol, sep_symbol)
+
+
+def _iter_raw_text(dom, block_symbol, sep_symbol):
+    # strings and the artificial newlines between the first and the last
+    # string
+    pending = []
+    seen_string = False
+    last = NOTHING
+    for event, node in etree.iterwalk(
+            dom, events=('start', 'end', 'comment', 'pi')):
+        tag = node.tag
+        if event == 'start':
+            if tag in SEPARATORS:
+                pending.append(sep_symbol)
+                last = True
+            elif tag not in INLINE_TAGS:
+                if callable(tag):
+                    # entities are skipped, except for their tail
+                    continue
+                pending.append(block_symbol)
+                last = None
+            string = node.text
+        else:
+            if (event == 'end' and tag not in INLINE_TAGS and
+                    tag not in SEPARATORS and not callable(tag)):
+                pending.append(block_symbol)
+                last = None
+            if node is dom:
+                break
+            string = node.tail
+        if string is not None:
+            if seen_string and pending:
+                yield ''.join(pending)
+            pending = []
+            seen_string = True
+            yield string
+    if not seen_string and last is not NOTHING:
+        yield block_symbol if last is None else sep_symbol
+
+
+def _iter_squashed_text(dom, block_symbol, sep_symbol):
+    # strings since the last artificial newline are merged and squashed.
+    # Newlines between non blank strings are kept, consecutive block
+    # newlines are squashed
+    sub = WHITESPACE_RE.sub
+    run = []
+    pending = []
+    pending_block = False
+    started = False
+    # for blank texts: the last newline, the last newline between two
+    # strings and the newline seen since the last string
+    last = between = since_string = NOTHING
+    seen_string = False
+    for event, node in etree.iterwalk(
+            dom, events=('start', 'end', 'comment', 'pi')):
+        tag = node.tag
+        if event == 'start':
+            if tag in SEPARATORS:
+                mark = True
+            elif tag in INLINE_TAGS:
+                mark = NOTHING
+            elif callable(tag):
+                # entities are skipped, except for their tail
+                continue
+            else:
+                mark = None
+            string = node.text
+        else:
+            if (event == 'end' and tag not in INLINE_TAGS and
+                    tag not in SEPARATORS and not callable(tag)):
+                mark = None
+            else:
+                mark = NOTHING
+            string = None if node is dom else node.tail
+        if mark is not NOTHING:
+            if run:
+                chunk = sub(' ', ''.join(run)).strip()
+                run = []
+                if chunk:
+                    if started:
+                        yield ''.join(pending)
+                    yield chunk
+                    started = True
+                    pending = []
+                    pending_block = False
+            if mark is True:
+                pending.append(sep_symbol)
+                pending_block = False
+            elif not pending_block:
+                pending.append(block_symbol)
+                pending_block = True
+            if not started:
+                last = mark
+                if seen_string:
+                    since_string = mark
+        if string is not None:
+            run.append(string)
+            if not started:
+                seen_string = True
+                if since_string is not NOTHING:
+                    between = since_string
+                    since_string = NOTHING
+        if node is dom and event != 'start':
             break
-    iterator = enumerate(parts[:start_idx - 1 if start_idx > 0 else None:-1])
-    for end_idx, pt in iterator:
-        if isinstance(pt, str):  # 0=None, 1=-1, 2=-2, index of last string
+    if run:
+        chunk = sub(' ', ''.join(run)).strip()
+        if chunk:
+            if started:
+                yield ''.join(pending)
+            yield chunk
+            started = True
+    if not started:
+        # only blank strings: the last remaining newline
+        last = between if seen_string else last
+        if last is not NOTHING:
+            chunk = (block_symbol if last is None else sep_symbol).strip()
+            if chunk:
+                yield chunk
+
+
+def join_chunks(chunks, max_chars=None, max_bytes=None):
+    """Join chunks of text, keeping at most max_chars characters and
+    max_bytes bytes once encoded in UTF-8. Chunks are consumed until the
+    limits are reached::
+
+        >>> join_chunks(iter(['ab', 'cd', 'ef']), max_chars=3)
+        'abc'
+        >>> join_chunks(['caf\u00e9'], max_bytes=4)
+        'caf'
+
+    """
+    for limit in (max_chars, max_bytes):
+        if limit is not None and limit < 0:
+            raise ValueError(f'Limits must be positive. Got {limit!r}')
+    if max_chars is None and max_bytes is None:
+        return ''.join(chunks)
+    parts = []
+    chars = size = 0
+    for chunk in chunks:
+        full = True
+        if max_chars is not None and chars + len(chunk) >= max_chars:
+            chunk = chunk[:max_chars - chars]
+            full = False
+        if max_bytes is not None:
+            data = chunk.encode('utf-8')
+            if size + len(data) >= max_bytes:
+                # never cut a character
+                chunk = data[:max_bytes - size].decode('utf-8', 'ignore')
+                data = chunk.encode('utf-8')
+                full = False
+            size += len(data)
+        parts.append(chunk)
+        chars += len(chunk)
+        if not full:
             break
-    return parts[start_idx:-end_idx if end_idx > 0 else None]
+    return ''.join(parts)
+
+
+def extract_text(dom, block_symbol='\n', sep_symbol='\n', squash_space=True,
+                 max_chars=None, max_bytes=None):
+    """Return the text of dom like a browser renders it. Block elements are
+    separated by block_symbol and ``<br>`` by sep_symbol. Whitespace is
+    squashed unless squash_space is false. The tree is walked once, without
+    recursion::
+
+        >>> from lxml import etree
+        >>> dom = etree.fromstring('<div><p>a <b>b</b></p>c<br/>d</div>')
+        >>> extract_text(dom, block_symbol='|', sep_symbol='/')
+        'a b|c/d'
+
+    The text can be limited to max_chars characters and max_bytes bytes of
+    UTF-8. The walk stops as soon as the limit is reached and the result is
+    the beginning of the full text::
+
+        >>> extract_text(dom, block_symbol='|', max_chars=4)
+        'a b|'
+
+    """
+    return join_chunks(iter_text(dom, block_symbol, sep_symbol, squash_space),
+                       max_chars, max_bytes)
+
+
+# The texts of nested elements are built from summaries of the subtrees of
+# block elements. Block elements start and end with an artificial newline,
+# so their text never merges with the text around them. A summary is a
+# (lead, body, trail) tuple: body is the text from the first string to the
+# last one, or None, lead and trail are the newlines around it.
+
+
+class _SquashedSummary:
+    # marks are None for artificial newlines, True for separators and ''
+    # for blank strings seen before the first chunk
+    __slots__ = ('block_symbol', 'body', 'lead', 'marks', 'run',
+                 'sep_symbol', 'string')
 
+    def __init__(self, block_symbol, sep_symbol):
+        self.block_symbol = block_symbol
+        self.sep_symbol = sep_symbol
+        self.run = []
+        self.string = self.run.append
+        self.marks = []
+        self.lead = self.body = None
 
-def _merge_original_parts(parts):
-    output, orp_buf = [], []
+    def mark(self, mark):
+        if self.run:
+            self.flush()
+        marks = self.marks
+        # consecutive block newlines and blank strings are squashed
+        if mark is True or not marks or marks[-1] != mark:
+            marks.append(mark)
 
-    def flush():
-        if orp_buf:
-            item = squash_html_whitespace(''.join(orp_buf)).strip()
-            if item:
-                output.append(item)
-            orp_buf[:] = []
+    def flush(self):
+        if self.run:
+            chunk = WHITESPACE_RE.sub(' ', ''.join(self.run)).strip()
+            self.run.clear()
+            if chunk:
+                self.chunk(chunk)
+            elif self.body is None:
+                self.mark('')
 
-    for x in parts:
-        if not isinstance(x, str):
-            flush()
-            output.append(x)
+    def chunk(self, chunk):
+        if self.body is None:
+            self.lead = lead = []
+            for mark in self.marks:
+                if mark is True or (mark is None and
+                                    (not lead or lead[-1] is not None)):
+                    lead.append(mark)
+            self.body = [chunk]
         else:
-            orp_buf.append(x)
-    flush()
-    return output
+            symbols = []
+            pending_block = False
+            for mark in self.marks:
+                if mark is True:
+                    symbols.append(self.sep_symbol)
+                    pending_block = False
+                elif not pending_block:
+                    symbols.append(self.block_symbol)
+                    pending_block = True
+            self.body.append(''.join(symbols))
+            self.body.append(chunk)
+        self.marks = []
 
+    def splice(self, summary):
+        lead, body, trail = summary
+        if self.run:
+            self.flush()
+        # blank strings only matter before the first chunk
+        started = self.body is not None
+        for mark in lead:
+            if not started or not isinstance(mark, str):
+                self.mark(mark)
+        if body is not None:
+            self.chunk(body)
+            for mark in trail:
+                self.mark(mark)
 
-def extract_text_array(dom, squash_artifical_nl=True, strip_artifical_nl=True):
-    if callable(dom.tag):
+    def summary(self):
+        self.flush()
+        if self.body is None:
+            return tuple(self.marks), None, ()
+        return tuple(self.lead), ''.join(self.body), tuple(self.marks)
+
+
+def _squashed_text(summary, block_symbol, sep_symbol):
+    lead, body, _ = summary
+    if body is not None:
+        return body
+    # only blank strings: like _iter_squashed_text
+    last = between = since_string = NOTHING
+    seen_string = False
+    for mark in lead:
+        if isinstance(mark, str):
+            seen_string = True
+            if since_string is not NOTHING:
+                between = since_string
+                since_string = NOTHING
+        else:
+            last = mark
+            if seen_string:
+                since_string = mark
+    last = between if seen_string else last
+    if last is NOTHING:
         return ''
-    r = []
-    if dom.tag in SEPARATORS:
-        r.append(True)  # equivalent of '\n' used to designate separators
-    elif dom.tag not in INLINE_TAGS:
-        # equivalent of '\n' used to designate artificially inserted newlines
-        r.append(None)
-    if dom.text is not None:
-        r.append(dom.text)
-    for child in dom.getchildren():
-        r.extend(extract_text_array(child, squash_artifical_nl=False,
-                                    strip_artifical_nl=False))
-        if child.tail is not None:
-            r.append(child.tail)
-    if dom.tag not in INLINE_TAGS and dom.tag not in SEPARATORS:
-        # equivalent of '\n' used to designate artificially inserted newlines
-        r.append(None)
-    if squash_artifical_nl:
-        r = _squash_artifical_nl(r)
-    if strip_artifical_nl:
-        r = _strip_artifical_nl(r)
-    return r
-
-
-def extract_text(dom, block_symbol='\n', sep_symbol='\n', squash_space=True):
-    a = extract_text_array(dom, squash_artifical_nl=squash_space)
-    if squash_space:
-        a = _strip_artifical_nl(_squash_artifical_nl(_merge_original_parts(a)))
-    result = ''.join(
-        block_symbol if x is None else (
-            sep_symbol if x is True else x
-        )
-        for x in a
-    )
+    return (block_symbol if last is None else sep_symbol).strip()
+
+
+class _RawSummary:
+    # lead and trail are the joined symbols of the newlines and the last
+    # newline
+    __slots__ = ('block_symbol', 'body', 'last', 'lead', 'sep_symbol',
+                 'symbols')
+
+    def __init__(self, block_symbol, sep_symbol):
+        self.block_symbol = block_symbol
+        self.sep_symbol = sep_symbol
+        self.symbols = []
+        self.last = NOTHING
+        self.lead = self.body = None
+
+    def string(self, string):
+        if self.body is None:
+            self.lead = (''.join(self.symbols), self.last)
+            self.body = [string]
+        else:
+            self.body.append(''.join(self.symbols))
+            self.body.append(string)
+        self.symbols = []
+
+    def mark(self, mark):
+        self.symbols.append(self.block_symbol if mark is None
+                            else self.sep_symbol)
+        self.last = mark
+
+    def _symbols(self, symbols, last):
+        if symbols:
+            self.symbols.append(symbols)
+            self.last = last
+
+    def splice(self, summary):
+        lead, body, trail = summary
+        self._symbols(*lead)
+        if body is not None:
+            self.string(body)
+            self._symbols(*trail)
+
+    def summary(self):
+        trail = (''.join(self.symbols), self.last)
+        if self.body is None:
+            return trail, None, ('', NOTHING)
+        return self.lead, ''.join(self.body), trail
+
+
+def _raw_text(summary, block_symbol, sep_symbol):
+    (_, last), body, _ = summary
+    if body is not None:
+        return body
+    if last is NOTHING:
+        return ''
+    return block_symbol if last is None else sep_symbol
+
+
+def _summarize(dom, factory, selected, memo):
+    """Return the summary of dom. The summaries of the block elements of
+    selected found in its subtree are stored in memo. Summaries already in
+    memo are used instead of walking their subtree"""
+    current = factory()
+    stack = []
+    skipped = None
+    walker = etree.iterwalk(dom, events=('start', 'end', 'comment', 'pi'))
+    for event, node in walker:
+        tag = node.tag
+        if event == 'start':
+            if tag in SEPARATORS:
+                current.mark(True)
+            elif tag not in INLINE_TAGS:
+                if callable(tag):
+                    # entities are skipped, except for their tail
+                    continue
+                if node is not dom:
+                    summary = memo.get(node)
+                    if summary is not None:
+                        current.splice(summary)
+                        walker.skip_subtree()
+                        skipped = node
+                        continue
+                    if node in selected:
+                        stack.append((node, current))
+                        current = factory()
+                current.mark(None)
+            string = node.text
+        else:
+            if (event == 'end' and tag not in INLINE_TAGS and
+                    tag not in SEPARATORS and not callable(tag) and
+                    node is not skipped):
+                current.mark(None)
+                if stack and stack[-1][0] is node:
+                    memo[node] = summary = current.summary()
+                    current = stack.pop()[1]
+                    current.splice(summary)
+            if node is dom:
+                break
+            string = node.tail
+        if string is not None:
+            current.string(string)
+    memo[dom] = summary = current.summary()
+    return summary
+
+
+def extract_texts(doms, block_symbol='\n', sep_symbol='\n', squash_space=True,
+                  memo=None):
+    """Return the text of each element of doms, like :func:`extract_text`.
+    The subtrees of block elements nested in other elements of doms are
+    walked once and their text reused for their ancestors::
+
+        >>> from lxml import etree
+        >>> dom = etree.fromstring('<div><p>a <b>b</b></p><p>c</p></div>')
+        >>> extract_texts([dom, dom[0], dom[1]], block_symbol='|')
+        ['a b|c', 'a b', 'c']
+
+    memo is a dict storing the summaries of the subtrees for these options.
+    It can be given to later calls as long as the tree is not modified.
+    """
     if squash_space:
-        result = result.strip()
-    return result
+        factory, render = _SquashedSummary, _squashed_text
+    else:
+        factory, render = _RawSummary, _raw_text
+
+    def new():
+        return factory(block_symbol, sep_symbol)
+
+    if memo is None:
+        memo = {}
+    selected = set(doms)
+    texts = []
+    for dom in doms:
+        if callable(dom.tag):
+            texts.append('')
+            continue
+        summary = memo.get(dom)
+        if summary is None:
+            summary = _summarize(dom, new, selected, memo)
+        texts.append(render(summary, block_symbol, sep_symbol))
+    return texts
@@ -1,19 +1,40 @@
 # Copyright (C) 2008 - Olivier Lauzanne <olauzanne@gmail.com>
 #
 # Distributed under the BSD license, see LICENSE.txt
+import asyncio
 import os
+import pathlib
+import pickle
 import sys
+import tempfile
+import threading
 import time
-from unittest import TestCase
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import ClassVar
+from unittest import TestCase, mock
+from urllib.request import urlopen
 
 import pytest
+from cssselect import SelectorError
 from lxml import etree
 from webtest import http
 from webtest.debugapp import debug_app
 
-from pyquery.openers import HAS_REQUEST
+from pyquery import Extractor, batch, openers, text
+from pyquery.index import ChainMatcher, compile_chains
+from pyquery.openers import HAS_REQUEST, FileCache, MemoryCache
+from pyquery.pyquery import (
+    FRAGMENT_CACHE_MAX_LENGTH,
+    compile_positional_plan,
+    compile_xpath,
+    css_to_xpath_cache,
+    document_order,
+    fragment_cache,
+    no_default,
+    xpath_cache,
+)
 from pyquery.pyquery import PyQuery as pq
-from pyquery.pyquery import no_default
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
@@ -280,6 +301,66 @@ class TestTraversal(TestCase):
         assert len(self.klass('#node2', self.html).find('span')) == 2
         assert len(self.klass('div', self.html).find('span')) == 3
 
+    def test_find_nested_context(self):
+        d = pq('<div id="a"><div id="b"><span id="c"/></div>'
+               '<span id="d"/></div>')
+        # nested contexts give unique results in document order
+        spans = d('div').find('span')
+        self.assertEqual([e.get('id') for e in spans], ['c', 'd'])
+        spans = self.klass('span', d('div')[::-1])
+        self.assertEqual([e.get('id') for e in spans], ['c', 'd'])
+
+    def test_document_order(self):
+        root = etree.fromstring('<a><b><c/><d/></b><e><f/></e></a>')
+        elements = list(root.iter())
+        shuffled = elements[::-1] + elements[2:4]
+        self.assertEqual(document_order(shuffled), elements)
+
+    def test_document_order_of_several_documents(self):
+        first = pq('<div><p>1</p><p>3</p></div>')
+        second = pq('<div><p>2</p></div>')
+        # the results of each document stay together, in input order
+        d = pq([first[0], second[0]])
+        self.assertEqual(d('p').texts(), ['1', '3', '2'])
+        self.assertEqual(d.find('p').texts(), ['1', '3', '2'])
+        self.assertEqual(d.children().texts(), ['1', '3', '2'])
+        d = pq([second[0], first[0]])
+        self.assertEqual(d.find('p').texts(), ['2', '1', '3'])
+        self.assertEqual(document_order([second('p')[0], first[0],
+                                         first('p')[0]]),
+                         [second('p')[0], first[0], first('p')[0]])
+
+    def test_unique_traversal(self):
+        d = pq('<div id="a"><p id="p1"><b id="b1"/></p><p id="p2"/>'
+               '<p id="p3"><b id="b2"/></p></div>')
+
+        def ids(q):
+            return [e.get('id') for e in q]
+
+        self.assertEqual(ids(d('b').parent()), ['p1', 'p3'])
+        self.assertEqual(ids(d('b').parents()), ['a', 'p1', 'p3'])
+        self.assertEqual(ids(d('p').parent()), ['a'])
+        self.assertEqual(ids(d('p').siblings()), ['p1', 'p2', 'p3'])
+        self.assertEqual(ids(d('#p2').siblings()), ['p1', 'p3'])
+        self.assertEqual(ids(d('p').next_all()), ['p2', 'p3'])
+        self.assertEqual(ids(d('p').prev_all()), ['p1', 'p2'])
+        self.assertEqual(ids(d('#p3, #p1').next()), ['p2'])
+        self.assertEqual(ids(d('div, b').children()),
+                         ['p1', 'p2', 'p3'])
+        self.assertEqual(ids(d('b').closest('p, div')), ['p1', 'p3'])
+        self.assertEqual(ids(d('b').closest('div')), ['a'])
+        self.assertEqual(ids(d('#p1, #p2').next_until('#p3')), ['p2'])
+
+    def test_traversal_of_large_selections(self):
+        d = pq('<div>%s</div>' % ('<p><b>x</b></p>' * 5000))
+        bs = d('b')
+        self.assertEqual(len(bs.parents()), 5001)
+        self.assertEqual(len(bs.parent().parent()), 1)
+        self.assertEqual(len(d('p').siblings()), 5000)
+        self.assertEqual(len(d('p').next_all()), 4999)
+        self.assertEqual(len(bs.closest('div')), 1)
+        self.assertEqual(d('p').parent(), [d[0]])
+
     def test_each(self):
         doc = self.klass(self.html)
         doc('span').each(lambda: doc(this).wrap("<em></em>"))  # NOQA
@@ -330,6 +411,937 @@ class TestTraversal(TestCase):
             d('#NOTHING').next_until('*'), [])
 
 
+class TestCaches(TestCase):
+
+    def test_css_to_xpath_cache(self):
+        css_to_xpath_cache.clear()
+        d = pq('<div><p class="a">1</p><p>2</p></div>')
+        self.assertEqual(len(d('p.a')), 1)
+        self.assertEqual(len(d('p.a')), 1)
+        info = css_to_xpath_cache.info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+        # xml documents use a case sensitive translator
+        x = pq('<div><P class="a"/></div>', parser='xml')
+        self.assertEqual(len(x('p.a')), 0)
+        self.assertEqual(css_to_xpath_cache.info().currsize, 2)
+
+    def test_css_to_xpath_cache_resize(self):
+        css_to_xpath_cache.resize(1)
+        try:
+            d = pq('<div><p class="a">1</p><p>2</p></div>')
+            d('p')
+            d('.a')
+            self.assertEqual(len(css_to_xpath_cache), 1)
+        finally:
+            css_to_xpath_cache.resize(1024)
+
+    def test_fragment_cache(self):
+        fragment_cache.clear()
+        d = pq('<div><p>a</p><p>b</p></div>')
+        d('p').append('<b>x</b>')
+        d('p').html('<b>x</b>')
+        d('p').prepend('<b>x</b>')
+        info = fragment_cache.info()
+        self.assertEqual((info.hits, info.misses), (2, 1))
+        # cached fragments are copied
+        d('b').text('changed')
+        d('p').append('<b>x</b>')
+        self.assertEqual(d('p').html(),
+                         '<b>changed</b><b>changed</b><b>x</b>')
+        fragment_cache.resize(0)
+        try:
+            d('p').html('<b>y</b>')
+            self.assertEqual(str(d('p')), '<p><b>y</b></p><p><b>y</b></p>')
+            self.assertEqual(len(fragment_cache), 0)
+        finally:
+            fragment_cache.resize(256)
+        # large fragments are not cached
+        fragment_cache.clear()
+        large = '<b>x</b>' * (FRAGMENT_CACHE_MAX_LENGTH // 8 + 1)
+        d('p').html(large)
+        self.assertEqual(len(d('b')), 2 * len(large) // 8)
+        self.assertEqual(len(fragment_cache), 0)
+
+    def test_compiled_xpath_cache(self):
+        xpath_cache.clear()
+        ns = {'foo': 'http://example.com/foo'}
+        self.assertIs(compile_xpath('//foo:bar', ns),
+                      compile_xpath('//foo:bar', dict(ns)))
+        self.assertIsNot(compile_xpath('//bar'),
+                         compile_xpath('//bar', {'x': 'y'}))
+        self.assertEqual(xpath_cache.info().hits, 1)
+
+    def test_compiled_xpath_reused(self):
+        d = pq('<div>' + '<p><span>x</span></p>' * 100 + '</div>')
+        ps = d('p')
+        expression = ps._css_to_xpath('span')
+        compiled = compile_xpath(expression)
+        self.assertEqual([e for tag in ps for e in tag.xpath(expression)],
+                         [e for tag in ps for e in compiled(tag)])
+        # the expression is compiled once for the whole selection
+        xpath_cache.clear()
+        self.assertEqual(len(ps.find('span')), 100)
+        self.assertEqual(len(ps.find('span')), 100)
+        info = xpath_cache.info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+
+class TestDocumentIndex(TestCase):
+    html = '''
+    <div id="main" class="box">
+      <ul class="list"><li class="item a">1</li><li class=" item b">2</li>
+        <li class="c	item">3</li><!-- comment --></ul>
+      <p id="p1" class="item">4</p>
+      <div class="box"><span class="x">5</span></div>
+    </div>
+    '''
+
+    def test_same_results(self):
+        d = pq(self.html)
+        di = pq(self.html, indexed=True)
+        for selector in ('#main', '.item', 'li', 'li.item', 'div.box',
+                         '#p1.item', '*', '.item, span, #main', '#nope',
+                         '.nope', 'LI', 'div li'):
+            self.assertEqual(
+                [e.get('id') or e.text for e in d(selector)],
+                [e.get('id') or e.text for e in di(selector)],
+                selector)
+            self.assertEqual(d('div').find(selector).text(),
+                             di('div').find(selector).text(), selector)
+            self.assertEqual(d('*').filter(selector).text(),
+                             di('*').filter(selector).text(), selector)
+        self.assertIsNotNone(di._index.root)
+        self.assertIs(di('li').eq(0)._index, di._index)
+
+    def test_invalidation(self):
+        d = pq(self.html, indexed=True)
+        self.assertEqual(len(d('.item')), 4)
+        d('span').add_class('item')
+        self.assertEqual(len(d('.item')), 5)
+        d('ul').append('<li class="item">6</li>')
+        self.assertEqual(d('li.item').text(), '1 2 3 6')
+        d('li').remove()
+        self.assertEqual(len(d('li')), 0)
+
+    def test_invalidation_by_other_objects(self):
+        d = pq(self.html, indexed=True)
+        self.assertEqual(d('li:nth-child(2)').text(), '2')
+        self.assertEqual(d('li').texts(), ['1', '2', '3'])
+        self.assertEqual(len(d.search('3')), 1)
+        pq(d('ul')[0]).prepend('<li class="a">0</li>')
+        self.assertEqual(d('li').text(), '0 1 2 3')
+        self.assertEqual(d('.a').text(), '0 1')
+        self.assertEqual(d('li:nth-child(2)').text(), '1')
+        self.assertEqual(d('li').texts(), ['0', '1', '2', '3'])
+        d('li').each(lambda i, e: pq(e).add_class('z'))
+        self.assertEqual(len(d('.z')), 4)
+        pq(d('p')[0]).text('3')
+        self.assertEqual(len(d.search('3')), 2)
+        # objects created from the elements share the index
+        self.assertIs(pq(d('li')[0])._index, d._index)
+
+    def test_other_document(self):
+        d = pq(self.html, indexed=True)
+        self.assertEqual(len(d('li', '<ul><li/></ul>')), 1)
+        self.assertEqual(len(d('<ul><li/></ul>')('li')), 1)
+        # copies holding another document do not use the index of d
+        o = d('<div><p class="a">1</p></div>')
+        self.assertIsNot(o._index, d._index)
+        self.assertEqual(len(o('.a')), 1)
+        pq(o[0]).append('<p class="a">2</p>')
+        self.assertEqual(len(o('.a')), 2)
+        self.assertEqual(len(d('.a')), 1)
+        self.assertIs(d._index.document, d[0].getroottree().getroot())
+        mixed = pq([d('li')[0], o[0]])
+        self.assertEqual(mixed.texts(), ['1', '1\n2'])
+        self.assertFalse(d._index.text_summaries)
+        self.assertEqual(mixed.search('2'), o('p:last'))
+
+    def test_contains(self):
+        d = pq(self.html)
+        di = pq(self.html, indexed=True)
+        for selector in (':contains("1")', 'li:contains("2")',
+                         'div:contains("45")', 'div:contains("5")',
+                         ".item:contains('3')", ':contains("comment")',
+                         'li:contains("1"), span:contains("5")',
+                         'div.box:contains("4"):contains("5")'):
+            self.assertEqual(str(d(selector)), str(di(selector)), selector)
+            self.assertEqual(str(d('ul').find(selector)),
+                             str(di('ul').find(selector)), selector)
+            self.assertEqual(str(d('*').filter(selector)),
+                             str(di('*').filter(selector)), selector)
+        self.assertIsNotNone(di._index.text)
+        di('span').text('6')
+        self.assertIsNone(di._index.text)
+        self.assertEqual(di('div:contains("5")'), [])
+
+    def test_search(self):
+        html = '<div><p>Price: <b>10</b> <i>$</i></p><p>Pri<b>ce</b></p></div>'
+        for d in (pq(html), pq(html, indexed=True)):
+            self.assertEqual(d.search('Price'), d('p'))
+            self.assertEqual(d.search('10'), d('b:first'))
+            self.assertEqual(d.search('10 $'), d('p:first'))
+            self.assertEqual(d('p:last').search('Price'), d('p:last'))
+            self.assertEqual(d('b').search('Price'), [])
+            self.assertEqual(d.search('nope'), [])
+
+    def test_contains_uses_the_text_index(self):
+        html = ('<div>' * 50 + '<p>lorem ipsum</p>' * 20 + '<p>Price</p>' +
+                '</div>' * 50)
+        d = pq(html)
+        di = pq(html, indexed=True)
+        self.assertEqual(str(d('div:contains("Price")')),
+                         str(di('div:contains("Price")')))
+        # the text of the document is built once and the elements containing
+        # a text are computed once, from the offsets of the text
+        text = di._index.text
+        containing = di._index.occurrences.get('Price')
+        self.assertEqual(len(containing), 51)
+        self.assertEqual(len(di('p:contains("Price")')), 1)
+        self.assertIs(di._index.text, text)
+        self.assertIs(di._index.occurrences.get('Price'), containing)
+
+
+class TestSiblingPositions(TestCase):
+    html = ('<div id="r"><ul>' + ''.join(
+        f'<li class="{"ab"[i % 3 == 0]}">{i}</li><!-- c --><b>x</b>'
+        for i in range(12)) + '</ul><p></p><ul><li>z</li></ul></div>')
+    selectors = ('li:nth-child(2n+1)', 'li:nth-child(even)',
+                 'li:nth-last-child(-n+4)', 'li:nth-of-type(3n)',
+                 'b:nth-last-of-type(2)', 'li:first-child', 'li:last-child',
+                 'li:only-child', 'li:only-of-type', 'b:first-of-type',
+                 '*:first-child', '*:last-child', '*:only-child',
+                 'li.a:nth-child(n+5)', 'li:nth-child(-2n+7), p:last-child')
+
+    def test_same_results(self):
+        d = pq(self.html)
+        di = pq(self.html, indexed=True)
+        for selector in self.selectors:
+            self.assertEqual(str(d(selector)), str(di(selector)), selector)
+            self.assertEqual(str(d('*').filter(selector)),
+                             str(di('*').filter(selector)), selector)
+        self.assertTrue(di._index.siblings)
+
+    def test_invalidation(self):
+        d = pq(self.html, indexed=True)
+        self.assertEqual(d('li:last-child').text(), 'z')
+        d('ul:last').append('<li>y</li>')
+        self.assertFalse(d._index.siblings)
+        self.assertEqual(d('li:last-child').text(), 'y')
+        self.assertEqual(d('li:contains(y)').index(), 1)
+
+    def test_other_document(self):
+        d = pq(self.html, indexed=True)
+        other = d('<ul><li>a</li><li>b</li></ul>')
+        mixed = pq([d('li')[0]] + other('li'))
+        self.assertIs(mixed._index, d._index)
+        self.assertEqual(mixed.filter(':first-child').text(), '0 a')
+        self.assertEqual(mixed.eq(2).index(), 1)
+        self.assertNotIn(other[0], d._index.siblings)
+        pq(other[0]).prepend('<li>z</li>')
+        self.assertEqual(mixed.filter(':first-child').text(), '0')
+        self.assertEqual(mixed.eq(2).index(), 2)
+
+    def test_index(self):
+        for d in (pq(self.html), pq(self.html, indexed=True)):
+            self.assertEqual(d('li').eq(2).index(), 4)
+            self.assertEqual(d('ul').index(), 0)
+            self.assertEqual(d('p').index(), 1)
+            self.assertEqual(d.index(), 0)
+            self.assertEqual(d('nope').index(), -1)
+            self.assertEqual(d('li').index(d('li').eq(3)), 3)
+            self.assertEqual(d('li').index(d('li')[5]), 5)
+            self.assertEqual(d('li').index(d('nope')), -1)
+            self.assertEqual(d('li').index(d('p')), -1)
+            self.assertEqual(d('li:contains(z)').index('li'), 12)
+            self.assertEqual(d('p').index('li'), -1)
+
+    def test_list_index(self):
+        d = pq(self.html)
+        texts = d('li').map(lambda i, e: pq(e).text())
+        self.assertEqual(texts.index(texts[1]), 1)
+        with self.assertRaises(ValueError):
+            texts.index('nope')
+        li = d('li')
+        self.assertEqual(li.index(li[2], 1), 2)
+        self.assertEqual(li.index(li[2], 1, 3), 2)
+        with self.assertRaises(ValueError):
+            li.index(li[0], 1)
+
+    def test_positions_computed_once(self):
+        html = '<table>' + '<tr><td>x</td></tr>' * 50 + '</table>'
+        d = pq(html)
+        di = pq(html, indexed=True)
+        self.assertEqual(len(d('tr:nth-child(2n)')), 25)
+        self.assertEqual(len(di('tr:nth-child(2n)')), 25)
+        # the positions of the rows are computed in one pass over their parent
+        self.assertEqual(list(di._index.siblings), [di('table')[0]])
+        entry = di._index.siblings[di('table')[0]]
+        self.assertEqual(len(di('tr:nth-last-child(-n+3)')), 3)
+        self.assertIs(di._index.siblings[di('table')[0]], entry)
+
+
+class TestMatcher(TestCase):
+    html = """
+    <div id="main" class="box"><!-- comment -->
+      <a id="a1" class="ext link" href="http://x.org/a.pdf" lang="en-US">a</a>
+      <a id="a2" class="link" href="/b" title="" data-x="a b">b</a>
+      <a id="a3" href="https://y.org" lang="en" title="x">c</a>
+      <p id="p1" class=" ext	">d</p>
+    </div>
+    """
+    selectors = ('a', '#a2', '.ext', 'a.link.ext', '*', 'A', '.nope',
+                 '[href]', '[HREF]', '[title=""]', '[title="x"]',
+                 '[title!=x]', '[title!=""]', '[data-x~=b]',
+                 '[data-x~="a b"]', '[lang|=en]', '[href^=http]',
+                 '[href^=""]', '[href$=".pdf"]', '[href*="org"]',
+                 'a[href*=""]', 'a:contains("b")', 'a.link, p.ext',
+                 'div#main.box')
+
+    def test_same_results(self):
+        for d in (pq(self.html), pq(self.html, parser='xml')):
+            elements = d('*') + d.contents()
+            elements._translator = d._translator
+            for selector in self.selectors:
+                self.assertIsNotNone(d._matcher(selector), selector)
+                xpath = d._css_to_xpath(selector, 'self::')
+                expected = [e for e in elements
+                            if not isinstance(e, str) and e.xpath(xpath)]
+                self.assertEqual(elements.filter(selector), expected,
+                                 selector)
+                self.assertEqual(elements.not_(selector),
+                                 [e for e in elements if e not in expected],
+                                 selector)
+                self.assertEqual(d('a').is_(selector),
+                                 bool(set(d('a')) & set(expected)), selector)
+
+    def test_fallback(self):
+        d = pq(self.html)
+        for selector in ('div a', 'a:first', 'a:has(b)', 'a:nth-child(1)',
+                         '[href^=http i]', 'svg|a'):
+            self.assertIsNone(d._matcher(selector), selector)
+        self.assertEqual(d('a').not_('a:last').text(), 'a b')
+        self.assertEqual(d('a').closest('div:has(p)'), d('#main'))
+        self.assertEqual(d('a').closest(), d('a'))
+
+    def test_has_class(self):
+        d = pq(self.html)
+        self.assertTrue(d('a').has_class('ext'))
+        self.assertTrue(d('p').has_class('ext'))
+        self.assertFalse(d('a').has_class('box'))
+
+    def test_closest_without_xpath(self):
+        d = pq('<div class="x">' +
+               '<div><p><span><b>x</b></span></p></div>' * 20 + '</div>')
+        bs = d('b')
+        xpath_cache.clear()
+        self.assertEqual(bs.closest('div.x'), [d[0]])
+        self.assertEqual(len(bs.closest('p')), 20)
+        # simple selectors are matched with the lxml API
+        self.assertEqual(len(xpath_cache), 0)
+        # others with XPath
+        self.assertEqual(len(bs.closest('div:has(p)')), 20)
+        self.assertTrue(xpath_cache)
+
+
+class TestPositional(TestCase):
+    html = """
+    <div id="d1"><ul><li id="l1"><a id="a1"></a><a id="a2"></a></li>
+      <li id="l2"><a id="a3"></a></li></ul></div>
+    <div id="d2"><ul><li id="l3"><a id="a4"></a></li>
+      <li id="l4" class="x"></li></ul></div>
+    """
+
+    def ids(self, elements):
+        return [e.get('id') for e in elements]
+
+    def test_set_level(self):
+        d = pq(self.html)
+        for selector, expected in (
+                ('a:first', ['a1']), ('a:last', ['a4']),
+                ('a:even', ['a1', 'a3']), ('a:odd', ['a2', 'a4']),
+                ('a:eq(2)', ['a3']), ('a:eq(-1)', ['a4']),
+                ('a:eq(9)', []), ('a:lt(2)', ['a1', 'a2']),
+                ('a:lt(-3)', ['a1']), ('a:gt(2)', ['a4']),
+                ('a:gt(-2)', ['a4']), ('a:gt(0):lt(2)', ['a2', 'a3']),
+                ('ul > li:last', ['l4']), ('div li.x:first', ['l4']),
+                ('li:first, a:last', ['l1', 'a4'])):
+            self.assertEqual(self.ids(d(selector)), expected, selector)
+            if ' ' not in selector:
+                self.assertEqual(self.ids(d('ul').find(selector)),
+                                 expected, selector)
+        self.assertEqual(self.ids(d('li')('a:first')), ['a1'])
+        self.assertEqual(self.ids(d('a', d('li'))), ['a1', 'a2', 'a3', 'a4'])
+        self.assertEqual(self.ids(d('li').find('a:last')), ['a4'])
+
+    def test_filter(self):
+        d = pq(self.html)
+        self.assertEqual(self.ids(d('a').filter(':first')), ['a1'])
+        self.assertEqual(self.ids(d('a').filter(':odd')), ['a2', 'a4'])
+        self.assertEqual(self.ids(d('li, a').filter('a:last, li:first')),
+                         ['l1', 'a4'])
+        self.assertTrue(d('a').is_(':last'))
+        self.assertEqual(self.ids(d('a').not_(':gt(0)')), ['a1'])
+
+    def test_not(self):
+        d = pq('<div><p>0<b/></p><p>1</p><p>2<i/></p><p>3</p></div>')
+        for selector, expected in ((':even', '0 2'), (':gt(1)', '2 3'),
+                                   (':first', '0'), ('p:has(b)', '0')):
+            self.assertEqual(d('p').filter(selector).text(), expected)
+            self.assertEqual(
+                d('p').not_(selector).text(),
+                ' '.join(t for t in '0123' if t not in expected))
+
+    def test_plan(self):
+        self.assertIsNone(compile_positional_plan('li a'))
+        self.assertIsNone(compile_positional_plan('li:first a'))
+        self.assertIsNone(compile_positional_plan('li:first.x'))
+        self.assertEqual(compile_positional_plan('li:first a:eq(1)'),
+                         [('li:first a', [('eq', 1)])])
+
+    def test_linear(self):
+        d = pq('<div>%s</div>' % ('<p><b>x</b></p>' * 10000))
+        self.assertEqual(len(d('p')('b:last')), 1)
+        self.assertEqual(len(d('p').find('b:odd')), 5000)
+
+
+class TestHasSemiJoin(TestCase):
+    html = """
+    <div id="a"><div id="b"><p id="p1"><a class="ext">x</a></p></div>
+      <div id="c"><b id="b1"></b><p id="p2"></p></div>
+      <ul id="u"><li id="l1"><a></a></li><li id="l2"></li></ul>
+    </div>
+    """
+    selectors = ('div:has(a.ext)', 'div:has(> p)', 'div:has(b, a)',
+                 ':has(a):has(b)', 'div > div:has(p)', 'li:has(a), p',
+                 '*:has(:has(.ext))', 'ul:has(> li:not(:has(a)))',
+                 'div:has(p a)', 'p:has(+ p)')
+
+    def ids(self, elements):
+        return [e.get('id') for e in elements]
+
+    def test_same_results(self):
+        d = pq(self.html)
+        for selector in self.selectors:
+            expected = d[0].xpath(d._css_to_xpath(selector))
+            self.assertEqual(self.ids(d(selector)), self.ids(expected),
+                             selector)
+            xpath = d._css_to_xpath(selector, 'self::')
+            expected = [e for tag in d('*') for e in tag.xpath(xpath)]
+            self.assertEqual(self.ids(d('*').filter(selector)),
+                             self.ids(expected), selector)
+            xpath = d._css_to_xpath(selector, 'descendant::')
+            expected = [e for tag in d('div') for e in tag.xpath(xpath)]
+            self.assertEqual(self.ids(d('div').find(selector)),
+                             self.ids(document_order(expected)), selector)
+
+    def test_plan(self):
+        d = pq(self.html)
+        for selector in ('div:has(a.ext)', 'div > div:has(> p)'):
+            self.assertIsNotNone(d._has_plan(selector, 'descendant::'))
+        # positional parts and combinators in :has() need xpath
+        for selector in ('div', 'div:has(a):first', 'div:has(p a)',
+                         'div:has(a:first)', 'p:has(+ p)'):
+            self.assertIsNone(d._has_plan(selector, 'descendant::'))
+
+    def test_semi_join(self):
+        html = '<div>' * 50 + '<p>x</p>' * 50 + '</div>' * 50
+        d = pq(html)
+        self.assertEqual(len(d('div:has(a.ext)')), 0)
+        # the inner and outer selectors are evaluated once, not once per
+        # candidate
+        with mock.patch.object(pq, '_evaluate', autospec=True,
+                               side_effect=pq._evaluate) as evaluate:
+            self.assertEqual(len(d('div:has(p)')), 50)
+        self.assertEqual(evaluate.call_count, 2)
+
+
+class TestSelectMany(TestCase):
+    html = """
+    <div id="main" class="box">
+      <ul class="list"><li class="item a">1</li><li class=" item b">2</li>
+        <li class="c	item"><a href="/x" class="item">3</a></li><!-- c --></ul>
+      <p id="p1" class="item">4 <span>five</span></p>
+      <div class="box inner"><span class="x\xa0y">5</span>
+        <div><p><span id="s2">6</span></p></div></div>
+    </div>
+    """
+    selectors = ('li', '.item', '#p1', 'ul > li', 'div span', 'div > span',
+                 'div.box p > span', 'div div span', '.box .box span',
+                 'li.item.a, p', '*', 'div *', 'a[href^="/"]',
+                 'p:contains("five") span', 'li a.item', '.x', 'SPAN',
+                 # not single walk
+                 'li:first', 'li + li', 'div:has(span)', 'p:nth-child(2)',
+                 'li:not(.a)')
+
+    def test_same_results(self):
+        for indexed in (False, True):
+            d = pq(self.html, indexed=indexed)
+            selectors = {str(i): s for i, s in enumerate(self.selectors)}
+            results = d.select_many(selectors)
+            self.assertEqual(list(results), list(selectors))
+            for name, selector in selectors.items():
+                self.assertEqual(list(results[name]), list(d(selector)),
+                                 selector)
+                self.assertIs(results[name].end(), d)
+
+    def test_contexts(self):
+        d = pq(self.html)
+        for contexts in (d('div'), d('li, p'), d('span, div.inner'),
+                         d('nothing')):
+            results = contexts.select_many(
+                {s: s for s in self.selectors})
+            for selector in self.selectors:
+                self.assertEqual(list(results[selector]),
+                                 list(contexts(selector)), selector)
+
+    def test_xml(self):
+        d = pq('<root><A><b/></A><a><B/></a></root>', parser='xml')
+        results = d.select_many({'a': 'a', 'b': 'A b', 'B': 'a > B'})
+        for selector, found in results.items():
+            self.assertEqual(list(found), list(d(selector)), selector)
+
+    def test_single_walk(self):
+        d = pq(self.html)
+        chains = {s: compile_chains(s) for s in ('ul > li', 'p, .x')}
+        self.assertTrue(all(chains.values()))
+        for selector in ('li:first', 'li + li', 'p:nth-child(2)'):
+            self.assertIsNone(compile_chains(selector))
+        results = ChainMatcher(chains).match([d[0]])
+        self.assertEqual([e.text for e in results['ul > li']],
+                         ['1', '2', None])
+
+    def test_one_walk(self):
+        d = pq('<div>' + ''.join(
+            f'<p class="c{i % 5}"><span>{i}</span></p>' for i in range(50)) +
+            '</div>')
+        selectors = {i: f'p.c{i} > span' for i in range(5)}
+        selectors['next'] = 'p + p > span'
+        expected = {name: d(selector) for name, selector in selectors.items()}
+        # selectors are matched in a single walk, except the one with a
+        # sibling combinator
+        with mock.patch.object(
+                ChainMatcher, 'match', autospec=True,
+                side_effect=ChainMatcher.match) as match, \
+                mock.patch.object(pq, '_select', autospec=True,
+                                  side_effect=pq._select) as select:
+            self.assertEqual(d.select_many(selectors), expected)
+        self.assertEqual(match.call_count, 1)
+        self.assertEqual(select.call_count, 1)
+
+
+class TestEarlyExit(TestCase):
+    html = TestSelectMany.html
+    selectors = TestSelectMany.selectors + ('nothing', 'li:last', 'ul li')
+
+    def test_same_results(self):
+        for indexed in (False, True):
+            d = pq(self.html, indexed=indexed)
+            for contexts in (d, d('div'), d('li, p'), d('nothing')):
+                for selector in self.selectors:
+                    expected = contexts(selector)
+                    self.assertEqual(list(contexts.first(selector)),
+                                     list(expected[:1]), selector)
+                    self.assertEqual(contexts.exists(selector),
+                                     bool(expected), selector)
+                    self.assertEqual(contexts.count(selector),
+                                     len(expected), selector)
+
+    def test_find_slice(self):
+        d = pq(self.html)
+        for selector in self.selectors:
+            expected = list(d('div').find(selector))
+            for offset, limit in ((0, 1), (1, 2), (2, None), (0, 0),
+                                  (10, 5)):
+                found = d('div').find(selector, limit=limit, offset=offset)
+                stop = None if limit is None else offset + limit
+                self.assertEqual(list(found), expected[offset:stop],
+                                 selector)
+        self.assertIs(d.find('li', limit=1).end(), d)
+        self.assertIs(d.first('li').end(), d)
+
+    def test_list_count(self):
+        d = pq(self.html)('li')
+        self.assertEqual(d.count(d[0]), 1)
+        self.assertEqual(d.count(None), 0)
+        texts = d.map(lambda i, e: pq(e).text())
+        self.assertEqual(texts.count(texts[0]), 1)
+        self.assertEqual(texts.count('nope'), 0)
+
+    def test_early_exit(self):
+        d = pq('<div>' + '<p class="x"><span>a</span></p>' * 50 + '</div>')
+        pulled = []
+        walk = ChainMatcher.iter
+
+        def iter(matcher, roots):
+            for match in walk(matcher, roots):
+                pulled.append(match)
+                yield match
+
+        # the walk stops at the first match
+        with mock.patch.object(ChainMatcher, 'iter', iter):
+            self.assertEqual(len(d.first('p.x span')), 1)
+            self.assertTrue(d.exists('p.x span'))
+        self.assertEqual(len(pulled), 2)
+        # elements are counted without building the list of matches
+        with mock.patch.object(pq, '_select', autospec=True,
+                               side_effect=pq._select) as select:
+            self.assertEqual(d.count('p.x span'), 50)
+        self.assertEqual(select.call_count, 0)
+
+
+class TestIterTraversal(TestCase):
+    html = TestSelectMany.html
+
+    def test_iter_find(self):
+        d = pq(self.html)
+        for contexts in (d, d('div'), d('li, p')):
+            for selector in TestEarlyExit.selectors:
+                self.assertEqual(list(contexts.iter_find(selector)),
+                                 list(contexts.find(selector)), selector)
+                self.assertEqual(
+                    [e[0] for e in contexts.items(selector)],
+                    list(contexts(selector)), selector)
+
+    def test_iter_traversal(self):
+        d = pq(self.html)
+        selectors = (None, 'div', '.item', 'li:first', 'li + li',
+                     'div:has(p)', ':not(.a)')
+        for elements in (d('span'), d('li'), d('#s2, a'), d('nothing')):
+            for method in ('parents', 'next_all', 'prev_all'):
+                for selector in selectors:
+                    found = list(getattr(elements, 'iter_' + method)(
+                        selector))
+                    expected = getattr(elements, method)(selector)
+                    self.assertEqual(len(found), len(set(found)))
+                    self.assertEqual(set(found), set(expected),
+                                     (method, selector))
+                    # in the order of the traversal
+                    traversal = list(getattr(elements, 'iter_' + method)())
+                    traversed = [e for e in found if e in set(traversal)]
+                    self.assertEqual(
+                        traversed, [e for e in traversal if e in set(found)],
+                        (method, selector))
+        # closest first
+        span = d('#s2')
+        self.assertEqual(list(span.iter_parents()),
+                         list(span[0].iterancestors()))
+        nested = pq('<div id="o"><ul/><div id="m"><ul><li><b/></li></ul>'
+                    '</div></div>')('b')
+        for selector in ('div', 'div:has(ul)', 'div:has(div, ul)'):
+            self.assertEqual(
+                [e.get('id') for e in nested.iter_parents(selector)],
+                ['m', 'o'])
+        li = d('li:last')
+        self.assertEqual(list(li.iter_prev_all()),
+                         list(li[0].itersiblings(preceding=True)))
+
+    def test_early_exit(self):
+        d = pq('<div>' + '<p class="x"><span>a</span></p>' * 50 +
+               '<p class="y"/></div>')
+        pulled = []
+        walk = ChainMatcher.iter
+        traverse = pq._traverse
+
+        def iter(matcher, roots):
+            for match in walk(matcher, roots):
+                pulled.append(match)
+                yield match
+
+        def _traverse(self, method):
+            for node in traverse(self, method):
+                pulled.append(node)
+                yield node
+
+        # nodes are only walked until the first match is found
+        with mock.patch.object(ChainMatcher, 'iter', iter):
+            self.assertEqual(next(d.iter_find('p.x span')).text, 'a')
+        self.assertEqual(len(pulled), 1)
+        del pulled[:]
+        p = d('p:first')
+        with mock.patch.object(pq, '_traverse', _traverse):
+            self.assertEqual(next(p.iter_next_all()), p[0].getnext())
+            self.assertEqual(len(pulled), 1)
+            self.assertEqual(next(p.iter_next_all('p:contains(a)')),
+                             p[0].getnext())
+            self.assertEqual(len(pulled), 2)
+            self.assertEqual(next(p.iter_next_all('.y')).get('class'), 'y')
+        self.assertEqual(len(pulled), 52)
+
+
+class TestIterparse(TestCase):
+
+    def feed(self, count):
+        yield b'<?xml version="1.0"?><!-- feed --><feed><title>t</title>'
+        for i in range(count):
+            yield b'<group>'
+            yield (b'<item id="%d"><name>n%d</name></item>' % (i, i))
+            yield b'</group>'
+        yield b'</feed>'
+
+    def test_iterable(self):
+        sizes = []
+        ids = []
+        for item in pq.iterparse(self.feed(1000), 'item'):
+            ids.append(item.attr('id'))
+            self.assertEqual(item('name').text(), 'n' + ids[-1])
+            root = item.root.getroot()
+            sizes.append(sum(1 for _ in root.iter()))
+        self.assertEqual(ids, [str(i) for i in range(1000)])
+        # processed records are dropped
+        self.assertLess(max(sizes), 10)
+
+    def test_combinator(self):
+        ids = [i.attr('id')
+               for i in pq.iterparse(self.feed(5), 'group > item[id="3"]')]
+        self.assertEqual(ids, ['3'])
+        tags = [i[0].tag for i in pq.iterparse(
+            self.feed(2), 'feed > title, group name, nope > item')]
+        self.assertEqual(tags, ['title', 'name', 'name'])
+
+    def test_file(self):
+        ps = pq.iterparse(path_to_html_file, 'p', parser='html')
+        self.assertEqual([p.attr('id') for p in ps], ['hello', 'test'])
+        with open(path_to_html_file, 'rb') as fd:
+            self.assertEqual(len(list(pq.iterparse(fd, 'p', parser='html'))),
+                             2)
+
+    def test_invalid_parser(self):
+        with self.assertRaises(ValueError):
+            next(pq.iterparse(b'<a/>', 'a', parser='foo'))
+
+
+def count_paragraphs(d):
+    return len(d('p'))
+
+
+class TestBatch(TestCase):
+
+    def test_extract(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for i in range(20):
+                # strings are paths, like the results of glob.glob()
+                paths.append(os.path.join(directory, f'{i}.html'))
+                with open(paths[-1], 'w') as fd:
+                    fd.write('<div>' + '<p>p</p>' * i + '</div>')
+            results = list(batch.extract(
+                paths, count_paragraphs, processes=2, chunksize=3))
+            self.assertEqual(results, list(range(20)))
+            results = batch.extract(
+                paths, count_paragraphs, processes=2, chunksize=3,
+                ordered=False, max_pending=1)
+            self.assertEqual(sorted(results), list(range(20)))
+
+    def test_extract_sources(self):
+        with open(path_to_html_file, 'rb') as fd, \
+                open(path_to_html_file) as text_fd:
+            sources = [b'<div><p>a</p><p>b</p></div>',
+                       batch.Markup('<div><p>c</p></div>'), fd, text_fd,
+                       pathlib.Path(path_to_html_file), path_to_html_file]
+            results = list(batch.extract(
+                sources, {'p': 'p', 'a': 'a'}, processes=1, parser='html'))
+        self.assertEqual(results[0], {'p': ['a', 'b'], 'a': []})
+        self.assertEqual(results[1], {'p': ['c'], 'a': []})
+        self.assertEqual(results[2], results[3])
+        self.assertEqual(results[2], results[4])
+        self.assertEqual(results[2], results[5])
+        self.assertEqual(results[2]['a'], ['python'])
+
+
+class TestExtractor(TestCase):
+
+    html = """
+           <div>
+             <h1>Products</h1>
+             <a href="/1">first</a><a href="/2">second</a>
+             <table>
+               <tr id="a"><td class="name">pen</td><td class="price">1.5</td>
+                 <td class="tags"><i>blue</i><i>cheap</i></td></tr>
+               <tr id="b"><td class="name">ink</td><td class="price"></td>
+                 <td class="tags"></td></tr>
+               <tr id="c"><td class="name">pad <b>A4</b></td>
+                 <td class="price">3</td><td class="tags"><i>paper</i></td>
+               </tr>
+             </table>
+             <textarea>a <b>b</b></textarea>
+           </div>
+           """
+
+    schema: ClassVar[dict] = {
+        'title': 'h1::text',
+        'links': ['a::attr(href)'],
+        'missing': 'h2',
+        'area': 'textarea',
+        'rows': {
+            '@each': 'tr',
+            'id': '::attr(id)',
+            'name': 'td.name',
+            'html': 'td.name::html',
+            'price': ('td.price:not(:empty)', Decimal),
+            'tags': ['td.tags i'],
+        },
+    }
+
+    def test_records(self):
+        d = pq(self.html)
+        record = Extractor(self.schema)(d)
+        self.assertEqual(record['title'], 'Products')
+        self.assertEqual(record['links'], ['/1', '/2'])
+        self.assertIsNone(record['missing'])
+        self.assertEqual(record['area'], d('textarea').text())
+        self.assertEqual(record['rows'], [
+            {'id': 'a', 'name': 'pen', 'html': 'pen',
+             'price': Decimal('1.5'), 'tags': ['blue', 'cheap']},
+            {'id': 'b', 'name': 'ink', 'html': 'ink', 'price': None,
+             'tags': []},
+            {'id': 'c', 'name': 'pad A4', 'html': 'pad <b>A4</b>',
+             'price': Decimal(3), 'tags': ['paper']},
+        ])
+
+    def test_same_as_queries(self):
+        d = pq(filename=path_to_html_file, parser='html')
+        extractor = Extractor({'links': ['a'], 'first': 'p',
+                               'ps': ['body p']})
+        self.assertEqual(extractor(d), {
+            'links': [pq(a).text() for a in d('a')],
+            'first': d('p').eq(0).text(),
+            'ps': [pq(p).text() for p in d('body p')],
+        })
+
+    def test_columnar(self):
+        d = pq(self.html)
+        rows = Extractor(self.schema).extract(d, columnar=True)['rows']
+        self.assertEqual(rows['id'], ['a', 'b', 'c'])
+        self.assertEqual(rows['price'], [Decimal('1.5'), None, Decimal(3)])
+        self.assertEqual(rows['tags'], [['blue', 'cheap'], [], ['paper']])
+
+        extractor = Extractor({'@each': 'li', 'n': ('::text', int)})
+        documents = ['<ul><li>1</li><li>2</li></ul>', '<ul></ul>',
+                     '<ul><li>3</li></ul>']
+        self.assertEqual(extractor.extract_many(documents),
+                         [[{'n': 1}, {'n': 2}], [], [{'n': 3}]])
+        self.assertEqual(extractor.extract_many(documents, columnar=True),
+                         {'n': [1, 2, 3]})
+
+    def test_nested(self):
+        extractor = Extractor({
+            'lists': {'@each': 'ul', 'items': {
+                '@each': 'li', 'text': '::text', 'sub': {'b': 'b'}}},
+            'header': {'title': 'h1'},
+            'empty': {'@each': 'li'},
+        })
+        d = pq('<div><h1>t</h1><ul><li><b>1</b></li><li>2</li></ul>'
+               '<ul></ul><ul><li>3</li></ul></div>')
+        self.assertEqual(extractor(d), {
+            'lists': [
+                {'items': [{'text': '1', 'sub': {'b': '1'}},
+                           {'text': '2', 'sub': {'b': None}}]},
+                {'items': []},
+                {'items': [{'text': '3', 'sub': {'b': None}}]},
+            ],
+            'header': {'title': 't'},
+            'empty': [{}, {}, {}],
+        })
+
+    def test_converters_are_batched(self):
+        calls = []
+
+        def converter(value):
+            calls.append(value)
+            return int(value)
+
+        extractor = Extractor({'@each': 'li', 'n': ('::text', converter),
+                               'ns': (['b'], converter)})
+        d = pq('<ul><li>1</li><li>2<b>3</b><b>4</b></li></ul>')
+        self.assertEqual(extractor(d), [{'n': 1, 'ns': []},
+                                        {'n': 234, 'ns': [3, 4]}])
+        self.assertEqual(calls, ['1', '234', '3', '4'])
+
+    def test_invalid_schemas(self):
+        self.assertRaises(SelectorError, Extractor, {'a': 'p[[::text'})
+        self.assertRaises(SelectorError, Extractor, {'a': {'@each': '!'}})
+        self.assertRaises(ValueError, Extractor, {'a': 'p::attr'})
+        self.assertRaises(ValueError, Extractor, {'a': ['p', 'a']})
+        self.assertRaises(TypeError, Extractor, {'a': ('p', 'int')})
+        self.assertRaises(TypeError, Extractor, {'a': 1})
+        self.assertRaises(TypeError, Extractor, ['p'])
+
+    def test_batch(self):
+        extractor = Extractor({'p': ['p'], 'n': ('p::attr(n)', int)})
+        extractor = pickle.loads(pickle.dumps(extractor))
+        sources = [b'<div><p n="%d">%d</p></div>' % (i, i) for i in range(5)]
+        results = list(batch.extract(sources, extractor, processes=1))
+        self.assertEqual(results, [{'p': [str(i)], 'n': i}
+                                   for i in range(5)])
+
+
+class TestLazy(TestCase):
+
+    html = """
+           <div id="main">
+             <ul class="menu">
+               <li class="item first"><a href="/a">a</a></li>
+               <!-- comment -->
+               <li class="item"><a class="ext" href="/b">b</a></li>
+               <li class="other"><span>c</span></li>
+             </ul>
+             <ul>
+               <li class="item"><a href="/d">d</a></li>
+             </ul>
+           </div>
+           """
+
+    def assertSame(self, lazy, eager):
+        self.assertEqual(list(lazy), list(eager))
+
+    def test_chains(self):
+        d = pq(self.html)
+        chains = [
+            lambda q: q('li').find('a'),
+            lambda q: q('ul').children('.item').find('a'),
+            lambda q: q('li').filter('.item').not_('.first'),
+            lambda q: q('a').parent().parent(),
+            lambda q: q('a').parents('ul'),
+            lambda q: q('li.first').next(),
+            lambda q: q('li.other').prev('.item'),
+            lambda q: q('li.first').next_all(),
+            lambda q: q('li.other').prev_all(),
+            lambda q: q('li').siblings('.other'),
+            lambda q: q('li:first').find('a'),
+            lambda q: q('ul > li').find('a, span'),
+            lambda q: q('li').eq(1).find('a'),
+            lambda q: q('li').filter(lambda i, e: i % 2 == 0).find('a'),
+            lambda q: q('a').parents().filter('ul').children(),
+        ]
+        for chain in chains:
+            self.assertSame(chain(d.lazy()), chain(d))
+
+    def test_fused(self):
+        d = pq(self.html)
+        chain = d.lazy()('ul').children('.item').find('a').attr('href')
+        self.assertEqual(chain, '/a')
+        chain = d.lazy()('ul').children('.item').find('a')
+        self.assertEqual(chain._source, d)
+        chain = d.lazy()('li').eq(1).find('a')
+        self.assertIsNot(chain._source, d)
+
+    def test_end(self):
+        d = pq(self.html)
+        chain = d.lazy()('li').filter('.item').find('a')
+        eager = d('li').filter('.item').find('a')
+        for _ in range(3):
+            chain, eager = chain.end(), eager.end()
+            self.assertSame(chain, eager)
+        self.assertIs(chain.end(), eager.end())
+
+    def test_evaluated_once(self):
+        d = pq(self.html)
+        chain = d.lazy()('a')
+        self.assertIs(chain.evaluate(), chain.evaluate())
+        self.assertEqual(chain.text(), 'a b d')
+
+
 class TestOpener(TestCase):
 
     def test_open_filename(self):
@@ -381,6 +1393,10 @@ class TestContentsStr(TestCase):
         doc = pq('<div>only text</div>')
         self.assertEqual(str(doc.contents()), 'only text')
 
+    def test_contents_of_comments(self):
+        d = pq('<div><!--c--><p>a</p></div>')
+        self.assertEqual(pq([d[0][0], d[0][1]]).contents(), ['a'])
+
 
 class TestCallback(TestCase):
     html = """
@@ -432,6 +1448,215 @@ class TestHook(TestCase):
         self.assertEqual(S('li').test(p=2).text(), 'Milk')
 
 
+def _squash_artifical_nl(parts):
+    output, last_nl = [], False
+    for x in parts:
+        if x is not None:
+            output.append(x)
+            last_nl = False
+        elif not last_nl:
+            output.append(None)
+            last_nl = True
+    return output
+
+
+def _strip_artifical_nl(parts):
+    if not parts:
+        return parts
+    for start_idx, pt in enumerate(parts):
+        if isinstance(pt, str):
+            # 0, 1, 2, index of first string [start_idx:...
+            break
+    iterator = enumerate(parts[:start_idx - 1 if start_idx > 0 else None:-1])
+    for end_idx, pt in iterator:
+        if isinstance(pt, str):  # 0=None, 1=-1, 2=-2, index of last string
+            break
+    return parts[start_idx:-end_idx if end_idx > 0 else None]
+
+
+def _merge_original_parts(parts):
+    output, orp_buf = [], []
+
+    def flush():
+        if orp_buf:
+            item = text.squash_html_whitespace(''.join(orp_buf)).strip()
+            if item:
+                output.append(item)
+            orp_buf[:] = []
+
+    for x in parts:
+        if not isinstance(x, str):
+            flush()
+            output.append(x)
+        else:
+            orp_buf.append(x)
+    flush()
+    return output
+
+
+def extract_text_array(dom, squash_artifical_nl=True,
+                       strip_artifical_nl=True):
+    # the recursive walk extract_text used to do, returning the parts of
+    # the text. Strings are text, None artificial newlines and True
+    # separators
+    if callable(dom.tag):
+        return ''
+    r = []
+    if dom.tag in text.SEPARATORS:
+        r.append(True)  # equivalent of '\n' used to designate separators
+    elif dom.tag not in text.INLINE_TAGS:
+        # equivalent of '\n' used to designate artificially inserted newlines
+        r.append(None)
+    if dom.text is not None:
+        r.append(dom.text)
+    for child in dom.getchildren():
+        r.extend(extract_text_array(child, squash_artifical_nl=False,
+                                    strip_artifical_nl=False))
+        if child.tail is not None:
+            r.append(child.tail)
+    if dom.tag not in text.INLINE_TAGS and dom.tag not in text.SEPARATORS:
+        # equivalent of '\n' used to designate artificially inserted newlines
+        r.append(None)
+    if squash_artifical_nl:
+        r = _squash_artifical_nl(r)
+    if strip_artifical_nl:
+        r = _strip_artifical_nl(r)
+    return r
+
+
+def reference_text(dom, block_symbol='\n', sep_symbol='\n',
+                   squash_space=True):
+    # the recursive implementation extract_text used to have
+    a = extract_text_array(dom, squash_artifical_nl=squash_space)
+    if squash_space:
+        a = _strip_artifical_nl(_squash_artifical_nl(
+            _merge_original_parts(a)))
+    result = ''.join(block_symbol if x is None else (
+        sep_symbol if x is True else x) for x in a)
+    return result.strip() if squash_space else result
+
+
+class TestText(TestCase):
+    html = """
+    <div id="main"> a <b> b </b><br/> c\u200b
+      <p>para<br>graph</p><p></p>  <p> </p><!-- c -->
+      <ul><li>1</li><li> <i>2</i></li><li><br/></li></ul><?pi x?>
+      <pre>  pre
+        text </pre><span>\xa0s\xa0</span><table><tr><td>x</td></tr></table>
+      <textarea> <b>t</b> </textarea>
+    </div>
+    """
+    options = ({}, {'squash_space': False},
+               {'block_symbol': '|', 'sep_symbol': '/'},
+               {'block_symbol': ' X ', 'sep_symbol': '', 'squash_space': False})
+
+    def test_same_text(self):
+        d = pq(self.html)
+        documents = [pq(html) for html in (
+            '<div></div>', '<br/>', '<b></b>', '<p> </p>', '<div>a</div>',
+            '<div><br/> <br/></div>', '<div><p> </p> <p> </p></div>',
+            '<span> <div></div> <br/> </span>')]
+        comments = [e for e in d[0].iter() if not isinstance(e.tag, str)]
+        for element in list(d('*')) + comments + [e[0] for e in documents]:
+            for options in self.options:
+                self.assertEqual(text.extract_text(element, **options),
+                                 reference_text(element, **options),
+                                 (element, options))
+
+    def test_entities(self):
+        parser = etree.XMLParser(resolve_entities=False)
+        dom = etree.fromstring('<!DOCTYPE a [<!ENTITY e "x">]>'
+                               '<a>1<b>2</b>&e;tail<!--c-->ct<?pi x?>pt</a>',
+                               parser)
+        self.assertEqual(text.extract_text(dom), '12tailctpt')
+        self.assertEqual(text.extract_text(dom[1]), '')
+
+    def test_deep_document(self):
+        depth = 5 * sys.getrecursionlimit()
+        root = element = etree.Element('div')
+        for _ in range(depth):
+            element = etree.SubElement(element, 'p')
+            element.text = 'a'
+        self.assertEqual(text.extract_text(root), '\n'.join('a' * depth))
+        self.assertEqual(pq(root).text(), '\n'.join('a' * depth))
+
+    def test_iter_text(self):
+        d = pq(self.html)
+        chunks = list(text.iter_text(d[0]))
+        self.assertEqual(''.join(chunks), d.text())
+        self.assertGreater(len(chunks), 1)
+        self.assertNotIn('', chunks)
+
+    def test_extract_texts(self):
+        d = pq(self.html)
+        comments = [e for e in d[0].iter() if not isinstance(e.tag, str)]
+        elements = list(d('*')) + comments
+        for order in (elements, elements[::-1]):
+            for options in self.options:
+                self.assertEqual(
+                    text.extract_texts(order, **options),
+                    [text.extract_text(e, **options) for e in order],
+                    options)
+
+    def test_texts(self):
+        d = pq(self.html)
+        elements = d('div, p, li, b, textarea')
+        self.assertEqual(elements.texts(),
+                         [pq(e).text() for e in elements])
+        self.assertEqual(elements.texts(squash_space=False),
+                         [pq(e).text(squash_space=False) for e in elements])
+        self.assertEqual(elements.text(), ' '.join(elements.texts()))
+        self.assertEqual(d('nothing').texts(), [])
+
+    def test_nested_texts(self):
+        depth = 5 * sys.getrecursionlimit()
+        root = element = etree.Element('div')
+        for _ in range(depth):
+            element = etree.SubElement(element, 'div')
+            element.text = 'a'
+        texts = pq(root)('div').texts()
+        self.assertEqual(texts[0], '\n'.join('a' * depth))
+        self.assertEqual(texts[-1], 'a')
+
+    def test_max_chars(self):
+        d = pq(self.html)
+        for options in self.options:
+            full = d.text(**options)
+            for size in range(len(full) + 2):
+                self.assertEqual(d.text(max_chars=size, **options),
+                                 full[:size])
+                self.assertEqual(
+                    text.extract_text(d[0], max_chars=size, **options),
+                    full[:size])
+
+    def test_max_bytes(self):
+        d = pq(self.html)
+        full = d('p, span').text()
+        data = full.encode('utf-8')
+        for size in range(len(data) + 2):
+            truncated = d('p, span').text(max_bytes=size)
+            self.assertEqual(truncated,
+                             data[:size].decode('utf-8', 'ignore'))
+        self.assertEqual(d.text(max_chars=1, max_bytes=2), 'a')
+        self.assertEqual(d.text(max_chars=3, max_bytes=2), 'a ')
+        with self.assertRaises(ValueError):
+            d.text(max_chars=-1)
+
+    def test_max_chars_stops_walk(self):
+        chunks = text.iter_text(pq('<div><p>a</p><p>b</p><p>c</p></div>')[0])
+        self.assertEqual(text.join_chunks(chunks, max_chars=2), 'a\n')
+        self.assertEqual(list(chunks), ['b', '\n', 'c'])
+
+    def test_cached_texts(self):
+        d = pq(self.html, indexed=True)
+        self.assertEqual(d('p').texts(), ['para\ngraph', '', ''])
+        self.assertEqual(len(d._index.text_summaries[()]), 3)
+        self.assertEqual(d('p').texts(), ['para\ngraph', '', ''])
+        d('p:first').text('changed')
+        self.assertEqual(d._index.text_summaries, {})
+        self.assertEqual(d('p').texts(), ['changed', '', ''])
+
+
 class TestManipulating(TestCase):
     html = '''
     <div class="portlet">
@@ -506,6 +1731,17 @@ Bacon</textarea>
         </div>
     '''
 
+    def test_multiple_targets(self):
+        for method, expected in (
+                ('append', '<p>as<b>x</b></p><p>bs<b>x</b></p>'),
+                ('prepend', '<p>s<b>x</b>a</p><p>s<b>x</b>b</p>'),
+                ('after', '<p>a</p>s<b>x</b><p>b</p>s<b>x</b>'),
+                ('before', 's<b>x</b><p>a</p>s<b>x</b><p>b</p>'),
+                ('html', '<p>s<b>x</b></p><p>s<b>x</b></p>')):
+            d = pq('<div><p>a</p><p>b</p></div>')
+            getattr(d('p'), method)('s<b>x</b>')
+            self.assertEqual(d.html(), expected, method)
+
     def test_attr_empty_string(self):
         d = pq('<div>')
         d.attr('value', '')
@@ -521,6 +1757,53 @@ Bacon</textarea>
         self.assertEqual(d.attr(id='z', class_='w').attr('id'), 'z')
         self.assertEqual(d.attr('class'), 'w')
 
+    def test_attrs(self):
+        d = pq('<p><a href="/a" class="x">A</a><!-- c -->'
+               '<a title="b">B</a><a href="" title="c">C</a></p>')
+        self.assertEqual(d('a').attrs('href'), ['/a', None, ''])
+        self.assertEqual(d('a').attrs('href', default='-'), ['/a', '-', ''])
+        self.assertEqual(d('a').attrs('href', skip_missing=True), ['/a', ''])
+        self.assertEqual(d('a').attrs('class_'), ['x', None, None])
+        self.assertEqual(d('a').attrs('href', 'title'),
+                         [('/a', None), (None, 'b'), ('', 'c')])
+        self.assertEqual(d('a').attrs('href', 'title', skip_missing=True),
+                         [('', 'c')])
+        self.assertEqual(d('p').contents().attrs('title'), [None, 'b', 'c'])
+        self.assertEqual(d('nope').attrs('href'), [])
+        with self.assertRaises(ValueError):
+            d('a').attrs()
+
+    def test_flexible_element(self):
+        d = pq('<a href="x" style="color: red">a</a>')
+        self.assertEqual(repr(d.attr), '<flexible_element attr>')
+        self.assertEqual(d.attr('href'), 'x')
+        self.assertEqual(d.attr.href, 'x')
+        self.assertEqual(d.attr['href'], 'x')
+        d.attr.title = 't'
+        d.attr['id'] = 'i'
+        self.assertEqual(d.attr('title'), 't')
+        del d.attr.title
+        del d.attr['id']
+        self.assertIsNone(d.attr('title'))
+        self.assertIsNone(d.attr('id'))
+        d.css.color = 'blue'
+        d.css['font-weight'] = 'bold'
+        self.assertEqual(d.attr('style'), 'color: blue; font-weight: bold')
+        with self.assertRaises(NotImplementedError):
+            del d.css.color
+        # elements are bound to their instance
+        attr = d.attr
+        self.assertEqual(pq('<b id="b"/>').attr.id, 'b')
+        self.assertEqual(attr.href, 'x')
+
+    def test_flexible_element_class(self):
+        d = pq('<a href="x">a</a>')
+        # the class of the elements is created once per descriptor
+        self.assertIs(type(d.attr), type(d.attr))
+        self.assertIs(type(d.attr), type(pq('<b/>').attr))
+        self.assertIsNot(type(d.attr), type(d.css))
+        self.assertEqual(d.attr('href'), 'x')
+
     def test_remove(self):
         d = pq(self.html)
         d('img').remove()
@@ -978,6 +2261,233 @@ class TestWebScrapping(TestCase):
         self.s.shutdown()
 
 
+class SlowHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/missing':
+            self.send_error(404)
+            return
+        if self.path == '/slow':
+            time.sleep(1)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.end_headers()
+        self.wfile.write(b'<html><p>%s</p></html>' % self.path.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+
+    def handle_error(self, request, client_address):
+        # clients may have given up on slow responses
+        pass
+
+
+class TestAsyncFetch(TestCase):
+
+    def setUp(self):
+        self.server = QuietHTTPServer(('127.0.0.1', 0), SlowHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def test_afetch(self):
+        d = asyncio.run(pq.afetch(self.url + '/foo'))
+        self.assertEqual(d('p').text(), '/foo')
+        self.assertEqual(d.base_url, self.url + '/foo')
+
+    def test_fetch_many(self):
+        urls = [f'{self.url}/{i}' for i in range(6)]
+        urls += [self.url + '/missing', self.url + '/slow']
+
+        async def collect():
+            return [r async for r in pq.fetch_many(
+                urls, concurrency=3, timeout=0.5)]
+
+        results = dict(asyncio.run(collect()))
+        self.assertEqual(sorted(results), sorted(urls))
+        for i in range(6):
+            self.assertEqual(results[urls[i]]('p').text(), f'/{i}')
+        self.assertIsInstance(results[self.url + '/missing'], Exception)
+        self.assertIsInstance(results[self.url + '/slow'],
+                              asyncio.TimeoutError)
+
+    def test_fetch_many_threads(self):
+        lock = threading.Lock()
+        running = []
+        concurrent = []
+
+        def opener(url, **kwargs):
+            # ignores the timeout
+            with lock:
+                running.append(url)
+                concurrent.append(len(running))
+            try:
+                with urlopen(url) as response:
+                    return response.read()
+            finally:
+                with lock:
+                    running.remove(url)
+
+        urls = [self.url + '/slow', self.url + '/a', self.url + '/b']
+
+        async def collect():
+            return [r async for r in pq.fetch_many(
+                urls, concurrency=1, timeout=0.5, opener=opener)]
+
+        results = asyncio.run(collect())
+        # the next urls wait for the thread of the slow one without timing
+        # out
+        self.assertEqual([url for url, result in results], urls)
+        self.assertIsInstance(results[0][1], asyncio.TimeoutError)
+        self.assertEqual([d('p').text() for url, d in results[1:]],
+                         ['/a', '/b'])
+        self.assertEqual(max(concurrent), 1)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+class ETagHandler(BaseHTTPRequestHandler):
+    requests: ClassVar[list] = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(b'<html><p>%s</p></html>' % self.path.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class TestResponseCache(TestCase):
+
+    def setUp(self):
+        ETagHandler.requests = []
+        self.server = QuietHTTPServer(('127.0.0.1', 0), ETagHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/page'
+
+    def test_memory_cache(self):
+        cache = MemoryCache()
+        for _ in range(3):
+            d = pq(url=self.url, data={'q': 'foo'}, cache=cache)
+            self.assertEqual(d('p').text(), '/page?q=foo')
+        self.assertEqual(len(ETagHandler.requests), 3)
+        info = cache.info()
+        self.assertEqual((info.hits, info.misses, info.revalidations),
+                         (0, 1, 2))
+        cache.ttl = 60
+        pq(url=self.url, data={'q': 'foo'}, cache=cache)
+        self.assertEqual(len(ETagHandler.requests), 3)
+        self.assertEqual(cache.info().hits, 1)
+
+    def test_cache_key(self):
+        cache = MemoryCache(ttl=60)
+        for _ in range(2):
+            pq(url=self.url, cache=cache)
+            pq(url=self.url, headers={'Accept-Language': 'fr'}, cache=cache)
+            pq(url=self.url, encoding='latin-1', cache=cache)
+        self.assertEqual(len(ETagHandler.requests), 3)
+        # credentials bypass the cache
+        for _ in range(2):
+            pq(url=self.url, cookies={'a': 'b'}, cache=cache)
+        self.assertEqual(len(ETagHandler.requests), 5)
+        info = cache.info()
+        self.assertEqual((info.hits, info.misses), (3, 3))
+
+    def test_memory_cache_eviction(self):
+        cache = MemoryCache(maxsize=50)
+        pq(url=self.url + '1', cache=cache)
+        pq(url=self.url + '2', cache=cache)
+        self.assertEqual(cache.currsize, 26)
+        self.assertIsNone(cache.get(self.url + '1'))
+        self.assertIsNotNone(cache.get(self.url + '2'))
+
+    def test_default_cache(self):
+        openers.default_cache = MemoryCache(ttl=60)
+        try:
+            pq(url=self.url)
+            pq(url=self.url)
+        finally:
+            openers.default_cache = None
+        self.assertEqual(len(ETagHandler.requests), 1)
+
+    def test_file_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = FileCache(directory)
+            pq(url=self.url, cache=cache)
+            cache = FileCache(directory)
+            d = pq(url=self.url, cache=cache)
+            self.assertEqual(d('p').text(), '/page')
+            self.assertEqual(cache.info().revalidations, 1)
+            # urllib returns bytes
+            body = cache.open(self.url + '2', {}, openers._urllib_response)
+            self.assertEqual(body, b'<html><p>/page2</p></html>')
+            body = cache.open(self.url + '2', {}, openers._urllib_response)
+            self.assertEqual(body, b'<html><p>/page2</p></html>')
+            self.assertEqual(cache.info().revalidations, 2)
+            # the directory is only scanned to remove entries
+            with mock.patch.object(FileCache, '_files',
+                                   side_effect=FileCache._files,
+                                   autospec=True) as files:
+                pq(url=self.url + '3', cache=cache)
+            self.assertEqual(files.call_count, 0)
+            self.assertEqual(cache.currsize, FileCache(directory).currsize)
+            cache.maxsize = cache.currsize + 10
+            with mock.patch.object(FileCache, '_files',
+                                   side_effect=FileCache._files,
+                                   autospec=True) as files:
+                pq(url=self.url + '4', cache=cache)
+            self.assertEqual(files.call_count, 1)
+            self.assertEqual(len(os.listdir(directory)), 3)
+            self.assertEqual(cache.currsize, FileCache(directory).currsize)
+            cache.clear()
+            self.assertEqual(cache.currsize, 0)
+
+    def test_file_cache_threads(self):
+        errors = []
+
+        def write(cache, n):
+            for i in range(50):
+                try:
+                    cache.set('key', {'body': 'x' * (100 + n + i % 7),
+                                      'etag': None, 'last_modified': None,
+                                      'time': 0})
+                    cache.get('key')
+                except Exception as e:  # NOQA
+                    errors.append(e)
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = FileCache(directory)
+            threads = [threading.Thread(target=write, args=(cache, n))
+                       for n in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(len(os.listdir(directory)), 1)
+            self.assertEqual(cache.currsize, FileCache(directory).currsize)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
 class TestWebScrappingEncoding(TestCase):
 
     @pytest.mark.skip('No longer possible to query this url')